@@ -1,13 +1,242 @@
 """
+Script for merging every department's scrape output into output/final/
 """
 import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from modules import constants as const
-import csv
-import os
+from modules import sinks
+
+def header_bytes(columns: list[str]) -> bytes:
+    """
+    Header line exactly as csv.writer writes it for the scrape tables
+    """
+    return (",".join(columns) + "\n").encode("utf-8")
+
+def copy_range(src_fd: int, dst_fd: int, offset: int, count: int):
+    """
+    Copy count bytes starting at offset of src_fd onto the end of dst_fd
+    Uses in-kernel copies where the platform has them, otherwise large buffered reads
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            while count > 0:
+                copied = os.copy_file_range(src_fd, dst_fd, count, offset)
+                if copied == 0:
+                    return
+                offset += copied
+                count -= copied
+            return
+        except OSError:
+            pass
+
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    while count > 0:
+        chunk = os.read(src_fd, min(count, const.AGGREGATE_BUFFER_SIZE))
+        if not chunk:
+            return
+        os.write(dst_fd, chunk)
+        count -= len(chunk)
+
+def file_hash(path: str, size: int) -> str:
+    """
+    sha256 of the first size bytes of path
+    """
+    digest = hashlib.sha256()
 
-def main (verbose: bool) -> bool:
+    with open(path, "rb") as hashed:
+        while size > 0:
+            chunk = hashed.read(min(size, const.AGGREGATE_BUFFER_SIZE))
+            if not chunk:
+                break
+            digest.update(chunk)
+            size -= len(chunk)
+
+    return digest.hexdigest()
+
+def dept_state(path: str) -> dict:
+    """
+    Manifest entry of one department table
+    """
+    stat = os.stat(path)
+    terminated = True
+
+    if stat.st_size:
+        with open(path, "rb") as dept_csv:
+            dept_csv.seek(-1, os.SEEK_END)
+            terminated = dept_csv.read(1) == b"\n"
+
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "sha256": file_hash(path, stat.st_size),
+        "terminated": terminated,
+    }
+
+def scraped_departments() -> list[str]:
+    """
+    Departments that have scrape output
+    """
+    return [dept for dept in const.DEPARTMENTS if os.path.isfile(f"{const.SCRAPE_OUTPUT_PATH}{dept}/outlines.csv")]
+
+def append_body(final_fd: int, path: str, offset: int) -> int:
     """
+    Append path from offset onwards to the final table, newline terminated
+    Returns the number of bytes written
+    """
+    with open(path, "rb") as dept_csv:
+        size = os.fstat(dept_csv.fileno()).st_size
+
+        if size <= offset:
+            return 0
+
+        copy_range(dept_csv.fileno(), final_fd, offset, size - offset)
+
+        dept_csv.seek(-1, os.SEEK_END)
+        if dept_csv.read(1) != b"\n":
+            os.write(final_fd, b"\n")
+            return size - offset + 1
+
+    return size - offset
+
+def rebuild_table(table: str, columns: list[str]) -> tuple[bool, int, dict]:
+    """
+    Concatenate one table across all departments without parsing rows
+    Each department's header is checked once and only the body is copied
+    Returns success, bytes written and the table's manifest entry
+    """
+    expected = header_bytes(columns)
+    written = 0
+    departments = {}
+
+    with open(f"{const.OUTPUT_PATH}/final/{table}.csv", "wb", buffering=0) as final_csv:
+        final_csv.write(expected)
+        written += len(expected)
+
+        for dept in scraped_departments():
+            path = f"{const.SCRAPE_OUTPUT_PATH}{dept}/{table}.csv"
+
+            with open(path, "rb") as dept_csv:
+                header = dept_csv.readline()
+
+            if header.rstrip(b"\r\n") != expected.rstrip(b"\n"):
+                tqdm.write(const.err(f"Unexpected header in {dept}/{table}.csv: {header!r}"))
+                return False, written, {}
+
+            departments[dept] = dept_state(path)
+            written += append_body(final_csv.fileno(), path, len(header))
+
+    return True, written, {"size": written, "departments": departments}
+
+def update_table(table: str, columns: list[str], previous: dict) -> tuple[bool, int, dict] | None:
+    """
+    Append only what departments added since the manifest was written
+    Returns None when a department changed in any other way and the table needs a rebuild
+    """
+    final_path = f"{const.OUTPUT_PATH}/final/{table}.csv"
+
+    if not os.path.isfile(final_path) or os.path.getsize(final_path) != previous.get("size"):
+        return None
+
+    departments = dict(previous["departments"])
+    current = scraped_departments()
+
+    if any(dept not in current for dept in departments):
+        return None
+
+    appends = []
+
+    for dept in current:
+        path = f"{const.SCRAPE_OUTPUT_PATH}{dept}/{table}.csv"
+        stat = os.stat(path)
+        old = departments.get(dept)
+
+        if old is None:
+            with open(path, "rb") as dept_csv:
+                header = dept_csv.readline()
+
+            # Let the rebuild report the bad header
+            if header.rstrip(b"\r\n") != header_bytes(columns).rstrip(b"\n"):
+                return None
+
+            appends.append((dept, path, len(header)))
+            continue
+
+        if stat.st_size == old["size"] and stat.st_mtime_ns == old["mtime"]:
+            continue
+
+        # Only pure appends to a newline terminated file can be merged in place
+        if stat.st_size < old["size"] or not old["terminated"] or file_hash(path, old["size"]) != old["sha256"]:
+            return None
+
+        appends.append((dept, path, old["size"]))
+
+    written = 0
+
+    with open(final_path, "ab", buffering=0) as final_csv:
+        for dept, path, offset in appends:
+            written += append_body(final_csv.fileno(), path, offset)
+            departments[dept] = dept_state(path)
+
+    return True, written, {"size": previous["size"] + written, "departments": departments}
+
+def merge_table(table: str, columns: list[str], previous: dict | None) -> tuple[bool, int, dict, bool]:
+    """
+    Incrementally update a table when possible, otherwise rebuild it
+    Returns success, bytes written, the new manifest entry and whether it was rebuilt
+    """
+    if previous is not None:
+        updated = update_table(table, columns, previous)
+
+        if updated is not None:
+            return *updated, False
+
+    return *rebuild_table(table, columns), True
+
+def merge_parquet_table(table: str, columns: list[str]) -> tuple[bool, int, dict, bool]:
+    """
+    Stream every department's Parquet parts of table into output/final/<table>.parquet
+    Parquet files cannot be appended to, so this always rebuilds
+    """
+    sources = []
+    for dept in const.DEPARTMENTS:
+        sources.extend(sorted(glob.glob(f"{const.SCRAPE_OUTPUT_PATH}{dept}/{table}/*.parquet")))
+
+    destination = f"{const.OUTPUT_PATH}/final/{table}.parquet"
+    sinks.merge_parquet(sources, destination, columns)
+
+    return True, os.path.getsize(destination), {}, True
+
+def load_manifest() -> dict:
+    """
+    Manifest of the last aggregation, empty if there is none
+    """
+    try:
+        with open(const.AGGREGATE_MANIFEST_PATH, "r", encoding="utf-8") as manifest:
+            return json.load(manifest)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(manifest: dict):
+    """
+    Atomically replace the manifest
+    """
+    temp_path = const.AGGREGATE_MANIFEST_PATH + ".tmp"
+
+    with open(temp_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    os.replace(temp_path, const.AGGREGATE_MANIFEST_PATH)
+
+def main (verbose: bool, full: bool = False, sink: str = "csv") -> bool:
+    """
+    Merge the six scrape tables of every department, one worker per table
+    Only departments that changed since the last run are merged unless full is set
     """
 
     if not os.path.exists(f"{const.OUTPUT_PATH}/final/"):
@@ -15,82 +244,49 @@ def main (verbose: bool) -> bool:
         if verbose:
             tqdm.write(f"Succesfully created path for CSVs: {const.OUTPUT_PATH}/final")
 
+    previous = {} if full else load_manifest()
+
+    # Drop the manifest first so an interrupted merge can never be mistaken for a finished one
+    if os.path.isfile(const.AGGREGATE_MANIFEST_PATH):
+        os.remove(const.AGGREGATE_MANIFEST_PATH)
+
+    start = time.perf_counter()
+
     try:
-        with (
-            open(f"{const.OUTPUT_PATH}/final/outlines.csv", "w", encoding="utf-8") as outlines_csv,
-            open(f"{const.OUTPUT_PATH}/final/assessment_groups.csv", "w", encoding="utf-8") as assessment_groups_csv,
-            open(f"{const.OUTPUT_PATH}/final/assessments.csv", "w", encoding="utf-8") as assessments_csv,
-            open(f"{const.OUTPUT_PATH}/final/personnels.csv", "w", encoding="utf-8") as personnels_csv,
-            open(f"{const.OUTPUT_PATH}/final/sections.csv", "w", encoding="utf-8") as sections_csv,
-            open(f"{const.OUTPUT_PATH}/final/types.csv", "w", encoding="utf-8") as types_csv,
-        ):
-            #CSV Writers
-            outlines_writer = csv.writer(outlines_csv, lineterminator="\n")
-            assessment_groups_writer = csv.writer(assessment_groups_csv, lineterminator="\n")
-            assessments_writer = csv.writer(assessments_csv, lineterminator="\n")
-            personnels_writer = csv.writer(personnels_csv, lineterminator="\n")
-            sections_writer = csv.writer(sections_csv, lineterminator="\n")
-            types_writer = csv.writer(types_csv, lineterminator="\n")
-
-            #Write CSV headers
-            outlines_writer.writerow(const.outlines_columns)
-            assessment_groups_writer.writerow(const.assessment_groups_columns)
-            assessments_writer.writerow(const.assessments_columns)
-            personnels_writer.writerow(const.personnels_columns)
-            sections_writer.writerow(const.sections_columns)
-            types_writer.writerow(const.types_columns)
-
-            for dept in const.DEPARTMENTS:
-                if os.path.isfile(f"{const.SCRAPE_OUTPUT_PATH}{dept}/outlines.csv"):
-                    try:
-                        with (
-                            open(f"{const.SCRAPE_OUTPUT_PATH}{dept}/outlines.csv", "r", encoding="utf-8") as dept_outlines_csv,
-                            open(f"{const.SCRAPE_OUTPUT_PATH}{dept}/assessment_groups.csv", "r", encoding="utf-8") as dept_assessment_groups_csv,
-                            open(f"{const.SCRAPE_OUTPUT_PATH}{dept}/assessments.csv", "r", encoding="utf-8") as dept_assessments_csv,
-                            open(f"{const.SCRAPE_OUTPUT_PATH}{dept}/personnels.csv", "r", encoding="utf-8") as dept_personnels_csv,
-                            open(f"{const.SCRAPE_OUTPUT_PATH}{dept}/sections.csv", "r", encoding="utf-8") as dept_sections_csv,
-                            open(f"{const.SCRAPE_OUTPUT_PATH}{dept}/types.csv", "r", encoding="utf-8") as dept_types_csv,
-                        ):
-                    
-                            dept_outlines_reader = csv.reader(dept_outlines_csv)
-                            dept_assessment_groups_reader = csv.reader(dept_assessment_groups_csv)
-                            dept_assessments_reader = csv.reader(dept_assessments_csv)
-                            dept_personnels_reader = csv.reader(dept_personnels_csv)
-                            dept_sections_reader = csv.reader(dept_sections_csv)
-                            dept_types_reader = csv.reader(dept_types_csv)
-
-                            for i, row in enumerate(dept_outlines_reader):
-                                if i != 0:
-                                    outlines_writer.writerow(row)
-                           
-                            for i, row in enumerate(dept_assessment_groups_reader):
-                                if i != 0:
-                                    assessment_groups_writer.writerow(row)
-
-                            for i, row in enumerate(dept_assessments_reader):
-                                if i != 0:
-                                    assessments_writer.writerow(row)
-
-                            for i, row in enumerate(dept_personnels_reader):
-                                if i != 0:
-                                    personnels_writer.writerow(row)
-
-                            for i, row in enumerate(dept_sections_reader):
-                                if i != 0:
-                                    sections_writer.writerow(row)
-
-                            for i, row in enumerate(dept_types_reader):
-                                if i != 0:
-                                    types_writer.writerow(row)
-
-                    except IOError as e:
-                        tqdm.write(const.err(str(e)))
-                        return False
-
-    except IOError as e:
+        with ThreadPoolExecutor(max_workers=len(const.SCRAPE_TABLES)) as pool:
+            if sink == "parquet":
+                futures = {
+                    table: pool.submit(merge_parquet_table, table, columns)
+                    for table, columns in const.SCRAPE_TABLES.items()
+                }
+            else:
+                futures = {
+                    table: pool.submit(merge_table, table, columns, previous.get(table))
+                    for table, columns in const.SCRAPE_TABLES.items()
+                }
+            results = {table: future.result() for table, future in futures.items()}
+
+    except (IOError, ImportError) as e:
         tqdm.write(const.err(str(e)))
         return False
-    
+
+    elapsed = time.perf_counter() - start
+    total = sum(written for _, written, _, _ in results.values())
+
+    if verbose:
+        for table, (_, written, _, rebuilt) in results.items():
+            tqdm.write(f"  {table:<18}{written:>14,} bytes  {'rebuilt' if rebuilt else 'incremental'}")
+
+    tqdm.write(f"Merged {total:,} bytes in {elapsed:.2f}s ({total / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+
+    if not all(result for result, _, _, _ in results.values()):
+        return False
+
+    if sink == "parquet":
+        return True
+
+    save_manifest({table: entry for table, (_, _, entry, _) in results.items()})
+
     return True
 
 if __name__ == "__main__":
@@ -105,9 +301,22 @@ if __name__ == "__main__":
         help="Make output more verbose with logging"
     )
 
+    _ = parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Rebuild every final table instead of merging only changed departments"
+    )
+
+    _ = parser.add_argument(
+        "--sink",
+        choices=const.SINKS,
+        default="csv",
+        help="Format of the department tables to merge"
+    )
+
     args: argparse.Namespace = parser.parse_args()
 
-    if main(args.verbose):
+    if main(args.verbose, args.full, args.sink):
         tqdm.write("Process completed successfully.")
     else:
         tqdm.write("Process failed.")
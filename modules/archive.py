@@ -0,0 +1,149 @@
+"""
+Compressed local archive of fetched catalog and outline pages
+"""
+
+import codecs
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Iterator
+
+from modules import constants as const
+
+class PageArchive:
+    """
+    SQLite index of zlib compressed page bodies, keyed by URL, term and fetch time
+    Every fetch is kept so older snapshots stay available; replay reads the latest one.
+    """
+
+    def __init__(self, path: str = const.ARCHIVE_PATH):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL,
+                term TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                status INTEGER NOT NULL,
+                body BLOB NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pages_lookup ON pages (url, term, fetched_at)")
+        self._conn.commit()
+
+    def put(self, url: str, term: str, status: int, text: str):
+        """
+        Store one fetched page
+        """
+        self.put_compressed(url, term, status, zlib.compress(text.encode("utf-8"), const.ARCHIVE_COMPRESSION))
+
+    def put_compressed(self, url: str, term: str, status: int, body: bytes):
+        """
+        Store one fetched page already zlib compressed, e.g. while it was streamed
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO pages (url, term, fetched_at, status, body) VALUES (?, ?, ?, ?, ?)",
+                (url, term, time.time(), status, body),
+            )
+            self._conn.commit()
+
+    def latest(self, url: str, term: str, since: float = 0.0) -> tuple[int, str] | None:
+        """
+        Returns (status, text) of the most recent snapshot of url for term, or None if never archived
+        since ignores snapshots fetched before that time
+        """
+        with self._lock:
+            row = self._conn.execute(
+                """
+                SELECT status, body FROM pages WHERE url = ? AND term = ? AND fetched_at >= ?
+                ORDER BY fetched_at DESC, id DESC LIMIT 1
+                """,
+                (url, term, since),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return row[0], zlib.decompress(row[1]).decode("utf-8")
+
+    def iter_latest(self, url: str, term: str) -> tuple[int, Iterator[str]] | None:
+        """
+        latest, decompressing the text in chunks as it is consumed
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, body FROM pages WHERE url = ? AND term = ? ORDER BY fetched_at DESC, id DESC LIMIT 1",
+                (url, term),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        def chunks(body: bytes) -> Iterator[str]:
+            decompressor = zlib.decompressobj()
+            decoder = codecs.getincrementaldecoder("utf-8")()
+
+            for start in range(0, len(body), const.FETCH_STREAM_CHUNK):
+                yield decoder.decode(decompressor.decompress(body[start:start + const.FETCH_STREAM_CHUNK]))
+
+            yield decoder.decode(decompressor.flush(), final=True)
+
+        return row[0], chunks(row[1])
+
+    def iter_texts(self, limit: int | None = None):
+        """
+        Yields the text of successfully fetched pages, newest first
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT body FROM pages WHERE status = 200 ORDER BY fetched_at DESC, id DESC LIMIT ?",
+                (-1 if limit is None else limit,),
+            ).fetchall()
+
+        for (body,) in rows:
+            yield zlib.decompress(body).decode("utf-8")
+
+    def close(self):
+        """
+        Close the underlying connection
+        """
+        with self._lock:
+            self._conn.close()
+
+
+_archive: PageArchive | None = None # pylint: disable=invalid-name
+_archive_lock = threading.Lock()
+
+def get_archive() -> PageArchive:
+    """
+    Returns the process wide PageArchive, opening it on first use
+    """
+    global _archive # pylint: disable=global-statement
+
+    with _archive_lock:
+        if _archive is None:
+            _archive = PageArchive()
+
+    return _archive
+
+def close_archive():
+    """
+    Close and forget the process wide PageArchive, so forked workers open their own
+    """
+    global _archive # pylint: disable=global-statement
+
+    with _archive_lock:
+        if _archive is not None:
+            _archive.close()
+            _archive = None
@@ -0,0 +1,229 @@
+"""
+Deterministic parser for outline assessment sections
+Follows the same group/item weight rules as const.prompt so that the common
+"Name [NN%]" tables and lists never need a Gemini round-trip.
+"""
+
+import re
+from typing import NamedTuple
+
+from lxml import etree
+
+from modules import records
+from modules import weights
+
+PERCENT_LABEL = re.compile(r"[\[\(]?\s*\d+(?:\.\d+)?\s*%\s*[\]\)]?")
+TOTAL = re.compile(r"^\s*(?:grand\s+)?total\b", re.I)
+UNGRADED = re.compile(r"\bungraded\b|\bnot graded\b", re.I)
+OPTIONAL = re.compile(r"\boptional\b|\bbonus\b", re.I)
+GRADUATE_ONLY = re.compile(r"(?<!under)graduate", re.I)
+DROP = re.compile(
+    r"(?:lowest|worst)\s+(\w+)\s+(?:\w+\s+){0,3}?(?:is|are|will be)?\s*(?:dropped|drop|not counted)"
+    r"|drop(?:s|ped)?\s+(?:the\s+)?(?:lowest|worst)\s+(\w+)",
+    re.I,
+)
+# Counts and alternatives the rules cannot expand into items, e.g. "5 x 4%", "4% each", "best 4 of 5"
+MULTIPLE = re.compile(r"\b\d+\s*[x×]\s*\d|\beach\b|\bbest\s+\w+\s+(?:out\s+)?of\s+\w+", re.I)
+DATE = re.compile(r"\b(20\d{2})-(\d{2})-(\d{2})(?:[ T](\d{2}):(\d{2})(?::(\d{2}))?)?\b")
+NUMBER_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6}
+
+TABLE_ROWS = etree.XPath("descendant::tr")
+ROW_CELLS = etree.XPath("td|th")
+LIST_ITEMS = etree.XPath("descendant::li")
+LI_DEPTH = etree.XPath("count(ancestor::li)")
+TEXT_BLOCKS = etree.XPath("descendant::p|descendant::div[not(descendant::p or descendant::div)]")
+
+# Weights within this distance of each other are considered equal (the prompt's ±0.5%)
+TOLERANCE = 0.005
+
+class Entry(NamedTuple):
+    """
+    One "name [NN%]" line found in the section
+    """
+    level: int
+    name: str
+    percent: float
+    text: str
+    # More than one weight or a count the rules cannot expand, left for the LLM to read
+    ambiguous: bool = False
+
+def _text(element) -> str:
+    return " ".join(s.strip() for s in element.itertext() if s.strip())
+
+def _own_text(element) -> str:
+    """
+    Text of an li without the text of nested lists
+    """
+    parts = [element.text or ""]
+    for child in element:
+        if isinstance(child.tag, str) and child.tag not in ("ul", "ol"):
+            parts.append(" ".join(child.itertext()))
+        parts.append(child.tail or "")
+    return " ".join(" ".join(parts).split())
+
+def _entry(level: int, name_text: str, weight_text: str) -> Entry | None:
+    """
+    Build an Entry from a name and the text holding its weight
+    Returns None for total rows and lines that carry neither a weight nor an ungraded marker
+    """
+    if TOTAL.match(name_text):
+        return None
+
+    percents = weights.percents(weight_text)
+    name = " ".join(PERCENT_LABEL.sub(" ", name_text).split()).strip(" :-–—")
+    text = f"{name_text} {weight_text}" if weight_text != name_text else name_text
+    ambiguous = len(weights.percents(text)) > 1 or bool(MULTIPLE.search(text))
+
+    if percents:
+        # The largest value given, the same rule as weights.parse
+        return Entry(level, name, max(percents), text, ambiguous)
+    if UNGRADED.search(weight_text):
+        return Entry(level, name, 0.0, text, ambiguous)
+    return None
+
+def _entries(root) -> list[Entry]:
+    """
+    Weighted entries from tables, falling back to lists and then plain text lines
+    """
+    entries = []
+
+    for row in TABLE_ROWS(root):
+        cells = [_text(cell) for cell in ROW_CELLS(row)]
+        if not cells or not cells[0]:
+            continue
+        rest = " ".join(cells[1:])
+        entry = _entry(0, cells[0], rest if weights.PERCENT.search(rest) or UNGRADED.search(rest) else cells[0])
+        if entry:
+            entries.append(entry)
+
+    if entries:
+        return entries
+
+    for item in LIST_ITEMS(root):
+        own = _own_text(item)
+        entry = _entry(int(LI_DEPTH(item)), own, own)
+        if entry:
+            entries.append(entry)
+
+    if entries:
+        return entries
+
+    for br in root.iter("br"):
+        br.tail = "\n" + (br.tail or "")
+
+    for block in TEXT_BLOCKS(root):
+        for line in "".join(block.itertext()).splitlines():
+            entry = _entry(0, line.strip(), line.strip())
+            if entry:
+                entries.append(entry)
+
+    return entries
+
+def _drop(text: str) -> int:
+    match = DROP.search(text)
+    if not match:
+        return 0
+    word = (match.group(1) or match.group(2)).lower()
+    if word.isdigit():
+        return int(word)
+    return NUMBER_WORDS.get(word, 1)
+
+def _due_date(text: str) -> str | None:
+    match = DATE.search(text)
+    if not match:
+        return None
+    year, month, day, hour, minute, second = match.groups()
+    return f"{year}-{month}-{day} {hour or '00'}:{minute or '00'}:{second or '00'}"
+
+def _close(a: float, b: float) -> bool:
+    return abs(a - b) <= TOLERANCE
+
+def parse(section_html: str) -> tuple[records.CourseRecords | None, float]:
+    """
+    Parse an assessment section into groups and items
+    Returns the output with a confidence in [0, 1]; anything below
+    const.ASSESSMENT_RULES_MIN_CONFIDENCE should go to the LLM instead
+    """
+    root = etree.HTML(section_html) if section_html.strip() else None
+
+    if root is None:
+        return None, 0.0
+
+    entries = _entries(root)
+
+    if not entries:
+        return None, 0.0
+
+    # Nest deeper entries under the closest preceding top level entry
+    top_level = min(entry.level for entry in entries)
+    grouped: list[tuple[Entry, list[Entry]]] = []
+
+    for entry in entries:
+        if entry.level == top_level or not grouped:
+            grouped.append((entry, []))
+        else:
+            grouped[-1][1].append(entry)
+
+    confidence = 1.0
+    groups = []
+    assessments = []
+    total = 0.0
+
+    for n, (head, children) in enumerate(grouped, start=1):
+        group_id = f"G{n}"
+        weight = head.percent / 100
+        optional = bool(OPTIONAL.search(head.text) or GRADUATE_ONLY.search(head.text))
+
+        if not head.name:
+            confidence *= 0.5
+
+        if head.ambiguous or any(child.ambiguous for child in children):
+            confidence *= 0.2
+
+        if children:
+            child_total = sum(child.percent for child in children) / 100
+
+            if _close(child_total, 1.0):
+                item_weights = [weight * child.percent / 100 for child in children]
+            elif _close(child_total, weight):
+                item_weights = [child.percent / 100 for child in children]
+            else:
+                # Items neither relative to nor summing to their group
+                confidence *= 0.2
+                item_weights = [weight / len(children)] * len(children)
+
+            items = [(child.name or head.name, w, child.text) for child, w in zip(children, item_weights)]
+        else:
+            items = [(head.name, weight, head.text)]
+
+        drop = _drop(" ".join([head.text] + [child.text for child in children]))
+
+        if drop >= len(items):
+            # Dropping every item zeroes the group, the items were most likely not all listed
+            confidence *= 0.2
+
+        groups.append(records.AssessmentGroup(
+            id=group_id,
+            weight=weight,
+            count=len(items),
+            drop=drop,
+            name=head.name,
+            optional=optional,
+        ))
+
+        for index, (name, item_weight, text) in enumerate(items):
+            assessments.append(records.Assessment(
+                group_id=group_id,
+                weight=item_weight,
+                index=index,
+                due_date=_due_date(text),
+                name=name,
+            ))
+
+        if not optional:
+            total += weight
+
+    if not _close(total, 1.0):
+        confidence *= 0.2
+
+    return records.CourseRecords(assessment_groups=groups, assessments=assessments), confidence
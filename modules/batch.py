@@ -0,0 +1,446 @@
+"""
+Script for extracting a whole term through the Gemini batch API
+prepare  fetches every outline and writes one request per course that still needs Gemini
+submit   uploads the requests and starts a batch job
+collect  downloads the job's results once it has finished
+ingest   reads the results and commits every course's rows to the scrape sink
+"""
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dotenv import load_dotenv
+from tqdm import tqdm
+
+from modules import constants as const
+from modules import archive
+from modules import catalog
+from modules import extract
+from modules import fetch
+from modules import llm_cache
+from modules import models
+from modules import pipeline
+from modules import records
+from modules import sinks
+from modules.main import course_rows
+
+FINISHED_STATES = ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED")
+
+def batch_path(term: str, name: str) -> str:
+    """
+    Path of one of a term's batch files
+    """
+    return f"{const.BATCH_PATH}{term}/{name}"
+
+def load_env(*names: str) -> dict[str, str] | None:
+    """
+    Required .env values, None after reporting the first missing one
+    """
+    if not load_dotenv():
+        tqdm.write(const.err("Could not load .env"))
+        return None
+
+    values = {}
+
+    for name in names:
+        value = os.getenv(name)
+
+        if not value:
+            tqdm.write(const.err(f"Could not find {name} in .env"))
+            return None
+
+        values[name] = value
+
+    return values
+
+def request_line(key: str, personnels_html: str, assessments_html: str) -> str:
+    """
+    One GenerateContentRequest of the batch input file
+    """
+    return records.dumps({
+        "key": key,
+        "request": {
+            "contents": [
+                {"role": "user", "parts": [{"text": const.course_prompt(personnels_html, assessments_html)}]}
+            ],
+            "generationConfig": {
+                "responseMimeType": "application/json",
+                "responseJsonSchema": models.ParsedCourseOutput.model_json_schema(),
+            },
+        },
+    })
+
+def result_records(result: dict) -> records.CourseRecords | None:
+    """
+    Records from one line of the batch output, None for errors and unparsable responses
+    """
+    try:
+        text = result["response"]["candidates"][0]["content"]["parts"][0]["text"]
+        return records.CourseRecords.from_json(text)
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+def course_sections(
+    fetcher: fetch.FetchClient,
+    pages: archive.PageArchive,
+    url: str,
+    term: str,
+    *,
+    cookies: dict,
+    replay: bool,
+) -> tuple[str, str, str] | None:
+    """
+    Description, personnel HTML and assessment HTML of one outline page, None if it could not be read
+    """
+    try:
+        status, page_text = fetch.fetch_text(fetcher, pages, url, term, cookies=cookies, replay=replay)
+    except (LookupError, requests.RequestException) as e:
+        tqdm.write(const.warning(f"Could not fetch {url}: {e}"))
+        return None
+
+    if status == 404:
+        tqdm.write(const.warning(f"Page not found. 404 Error. {url}"))
+        return None
+
+    sections = pipeline.parse_page(page_text)
+
+    # Login and error pages parse without any outline sections
+    if sections is None:
+        tqdm.write(const.warning(f"No outline content found for {url}"))
+
+    return sections
+
+def prepare(
+    verbose: bool,
+    departments: list[str],
+    *,
+    per_host: int | None = None,
+    replay: bool = False,
+    use_rules: bool = True,
+    use_cache: bool = True,
+    sink: str = "csv",
+) -> bool:
+    """
+    Fetch and parse every outline of the term not yet in the sink
+    Courses the local parsers or the LLM cache fully answer need no request
+    Writes requests.jsonl for the batch job and courses.jsonl with what ingest needs
+    """
+    env = load_env("OUTLINE_BASE") if replay else load_env("COOKIE", "SESSION_COOKIE", "OUTLINE_BASE")
+
+    if env is None:
+        return False
+
+    catalog_loaded, index = catalog.main(verbose, departments, per_host=per_host, replay=replay)
+
+    if not catalog_loaded:
+        return False
+
+    term = index.term
+    os.makedirs(batch_path(term, ""), exist_ok=True)
+
+    fetcher = fetch.get_client(per_host)
+    pages = archive.get_archive()
+    cache = llm_cache.get_cache() if use_cache else None
+    cookies = {"csrftoken": env.get("COOKIE"), "sessionid": env.get("SESSION_COOKIE")}
+
+    requests_path = batch_path(term, "requests.jsonl")
+    courses_path = batch_path(term, "courses.jsonl")
+    prepared = 0
+    requested = 0
+
+    try:
+        with (
+            open(requests_path + ".tmp", "w", encoding="utf-8") as requests_file,
+            open(courses_path + ".tmp", "w", encoding="utf-8") as courses_file,
+            ThreadPoolExecutor(max_workers=per_host or const.FETCH_PER_HOST) as pool,
+        ):
+            for dept in tqdm(departments, unit="dept"):
+                with sinks.open_course_sink(sink, dept, term) as course_sink:
+                    covered_courses = course_sink.completed_codes()
+
+                courses = {}
+                for course in index.slice(dept):
+                    if course["url"] and course["courses"] not in covered_courses:
+                        courses.setdefault(course["courses"], course)
+
+                sections = pool.map(
+                    lambda course: course_sections(fetcher, pages, env["OUTLINE_BASE"] + course["url"], term, cookies=cookies, replay=replay),
+                    courses.values(),
+                )
+
+                for (code, course), parsed in zip(courses.items(), sections):
+                    if parsed is None:
+                        continue
+
+                    description, personnels_html, assessments_html = parsed
+                    local_personnels, local_assessments = extract.local_sections(personnels_html, assessments_html, use_rules)
+                    personnels_html = "" if local_personnels else personnels_html
+                    assessments_html = "" if local_assessments else assessments_html
+
+                    entry = {
+                        "key": code,
+                        "dept": dept,
+                        "course": course,
+                        "description": description,
+                        "local_personnels": local_personnels.to_dict() if local_personnels else None,
+                        "local_assessments": local_assessments.to_dict() if local_assessments else None,
+                    }
+
+                    if personnels_html or assessments_html:
+                        key = extract.cache_key(personnels_html, assessments_html)
+                        cached = cache.get(key, records.CourseRecords.from_json) if cache is not None else None
+
+                        if cached is not None:
+                            entry["extracted"] = cached.to_dict()
+                        else:
+                            entry["cache_key"] = key
+                            requests_file.write(request_line(code, personnels_html, assessments_html) + "\n")
+                            requested += 1
+                    else:
+                        entry["extracted"] = records.CourseRecords().to_dict()
+
+                    courses_file.write(records.dumps(entry) + "\n")
+                    prepared += 1
+
+        os.replace(requests_path + ".tmp", requests_path)
+        os.replace(courses_path + ".tmp", courses_path)
+
+    except IOError as e:
+        tqdm.write(const.err(str(e)))
+        return False
+
+    tqdm.write(f"Prepared {prepared} courses for term {term}, {requested} need Gemini: {requests_path}")
+
+    return True
+
+def submit(verbose: bool) -> bool:
+    """
+    Upload requests.jsonl and start a batch job, remembering its name in job.txt
+    """
+    env = load_env("TERM", "GEMINI_API_KEY")
+
+    if env is None:
+        return False
+
+    requests_path = batch_path(env["TERM"], "requests.jsonl")
+    client = extract.get_client(env["GEMINI_API_KEY"])
+
+    uploaded = client.files.upload(
+        file=requests_path,
+        config={"display_name": f"outlines-{env['TERM']}", "mime_type": "jsonl"},
+    )
+    job = client.batches.create(
+        model=const.GEMINI_MODEL,
+        src=uploaded.name,
+        config={"display_name": f"outlines-{env['TERM']}"},
+    )
+
+    with open(batch_path(env["TERM"], "job.txt"), "w", encoding="utf-8") as job_file:
+        job_file.write(job.name)
+
+    if verbose:
+        tqdm.write(f"Uploaded {requests_path} as {uploaded.name}")
+
+    tqdm.write(f"Submitted batch job {job.name}")
+
+    return True
+
+def collect(verbose: bool) -> bool:
+    """
+    Download the submitted job's results to results.jsonl once it has finished
+    """
+    env = load_env("TERM", "GEMINI_API_KEY")
+
+    if env is None:
+        return False
+
+    try:
+        with open(batch_path(env["TERM"], "job.txt"), "r", encoding="utf-8") as job_file:
+            name = job_file.read().strip()
+    except IOError:
+        tqdm.write(const.err("No submitted batch job for this term, run submit first"))
+        return False
+
+    client = extract.get_client(env["GEMINI_API_KEY"])
+    job = client.batches.get(name=name)
+    state = job.state.name if job.state else "JOB_STATE_UNSPECIFIED"
+
+    if verbose:
+        tqdm.write(f"Batch job {name}: {state} {job.completion_stats or ''}")
+
+    if state not in FINISHED_STATES:
+        tqdm.write(const.warning(f"Batch job {name} is {state}, nothing to collect yet"))
+        return False
+
+    results_path = batch_path(env["TERM"], "results.jsonl")
+    client.files.download(file=job.dest.file_name, destination=results_path)
+    tqdm.write(f"Downloaded results to {results_path}")
+
+    return True
+
+def ingest(verbose: bool, *, results_path: str | None = None, sink: str = "csv", use_cache: bool = True) -> bool:
+    """
+    Commit every prepared course whose extraction is available, in prepare order
+    Courses without a usable result are left out so the next prepare picks them up again
+    """
+    env = load_env("TERM")
+
+    if env is None:
+        return False
+
+    term = env["TERM"]
+    results_path = results_path or batch_path(term, "results.jsonl")
+    cache = llm_cache.get_cache() if use_cache else None
+    results = {}
+
+    try:
+        with open(results_path, "r", encoding="utf-8") as results_file:
+            for line in results_file:
+                if line.strip():
+                    result = records.loads(line)
+                    results[result.get("key")] = result_records(result)
+
+        with open(batch_path(term, "courses.jsonl"), "r", encoding="utf-8") as courses_file:
+            entries = [records.loads(line) for line in courses_file if line.strip()]
+
+    except (IOError, ValueError) as e:
+        tqdm.write(const.err(str(e)))
+        return False
+
+    committed = 0
+    missing = []
+    course_sink = None
+    course_sink_dept = None
+    covered_courses = set()
+
+    try:
+        for entry in tqdm(entries, unit="course"):
+            if course_sink is None or course_sink_dept != entry["dept"]:
+                if course_sink is not None:
+                    course_sink.close()
+                course_sink = sinks.open_course_sink(sink, entry["dept"], term)
+                course_sink_dept = entry["dept"]
+                covered_courses = course_sink.completed_codes()
+
+            if entry["key"] in covered_courses:
+                continue
+
+            if "extracted" in entry:
+                extracted = records.CourseRecords.from_dict(entry["extracted"])
+            else:
+                extracted = results.get(entry["key"])
+
+                if extracted is None:
+                    missing.append(entry["key"])
+                    continue
+
+                if cache is not None:
+                    cache.put(entry["cache_key"], const.GEMINI_MODEL, extracted.to_json())
+
+            extracted = extract.merge_local(
+                extracted,
+                records.CourseRecords.from_dict(entry["local_personnels"]) if entry["local_personnels"] else None,
+                records.CourseRecords.from_dict(entry["local_assessments"]) if entry["local_assessments"] else None,
+            )
+
+            course_sink.commit(course_rows(entry["course"], term, entry["description"], extracted))
+            committed += 1
+
+    except (IOError, ImportError) as e:
+        tqdm.write(const.err(str(e)))
+        return False
+
+    finally:
+        if course_sink is not None:
+            course_sink.close()
+
+    if missing:
+        tqdm.write(const.warning(f"{len(missing)} courses had no usable batch result and were skipped"))
+        if verbose:
+            tqdm.write(", ".join(missing))
+
+    tqdm.write(f"Committed {committed} courses for term {term}")
+
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Script for updating DB through the Gemini batch API"
+    )
+
+    _ = parser.add_argument(
+        "phase",
+        choices=("prepare", "submit", "collect", "ingest"),
+        help="Batch phase to run"
+    )
+
+    _ = parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Make output more verbose with logging"
+    )
+
+    _ = parser.add_argument(
+        "--per-host",
+        type=int,
+        default=const.FETCH_PER_HOST,
+        help="Maximum concurrent connections per host while preparing"
+    )
+
+    _ = parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Ignore cached extraction results while preparing and ingesting"
+    )
+
+    _ = parser.add_argument(
+        "--no-rules",
+        action="store_true",
+        help="Send every section to Gemini instead of parsing well-formed ones locally"
+    )
+
+    _ = parser.add_argument(
+        "--sink",
+        choices=const.SCRAPE_SINKS,
+        default="csv",
+        help="Output format for the scraped tables"
+    )
+
+    _ = parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="Prepare from archived pages without touching the network"
+    )
+
+    _ = parser.add_argument(
+        "--results",
+        default=None,
+        help="Batch output file to ingest, defaults to the one collect downloads"
+    )
+
+    args: argparse.Namespace = parser.parse_args()
+
+    if args.phase == "prepare":
+        phase_ok = prepare(
+            args.verbose,
+            const.DEPARTMENTS,
+            per_host=args.per_host,
+            replay=args.replay,
+            use_rules=not args.no_rules,
+            use_cache=not args.no_cache,
+            sink=args.sink,
+        )
+    elif args.phase == "submit":
+        phase_ok = submit(args.verbose)
+    elif args.phase == "collect":
+        phase_ok = collect(args.verbose)
+    else:
+        phase_ok = ingest(args.verbose, results_path=args.results, sink=args.sink, use_cache=not args.no_cache)
+
+    if phase_ok:
+        tqdm.write("Process completed successfully.")
+    else:
+        tqdm.write("Process failed.")
@@ -0,0 +1,205 @@
+"""
+Fetch the course catalog once per term and partition it by department
+"""
+
+import json
+import os
+import time
+from typing import Iterable, Iterator
+
+from dotenv import load_dotenv
+from tqdm import tqdm
+
+from modules import constants as const
+from modules import fetch
+from modules import archive
+from modules import metrics
+
+def dept_prefix(course: dict) -> str:
+    """
+    Department prefix of a catalog entry, e.g. "CS" for "CS 135"
+    """
+    return course["courses"].split(" ", 1)[0]
+
+def iter_array(chunks: Iterable[str]) -> Iterator[dict]:
+    """
+    Decode the items of a top level JSON array as its text arrives, holding at most one partial item
+    chunks is always read to the end, so a streamed response is complete (and archived) once this returns
+    Raises ValueError for malformed JSON, an array that never closes or anything after it
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    expect = "["
+
+    for chunk in chunks:
+        buffer += chunk
+        pos = 0
+
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+
+            if pos == len(buffer):
+                break
+
+            if expect == "end":
+                raise ValueError(f"Unexpected {buffer[pos]!r} after JSON array")
+
+            if expect == "[":
+                if buffer[pos] != "[":
+                    raise ValueError(f"Expected a JSON array, got {buffer[pos]!r}")
+                pos += 1
+                expect = "first"
+            elif expect == "," and buffer[pos] == ",":
+                pos += 1
+                expect = "item"
+            elif expect in ("first", ",") and buffer[pos] == "]":
+                pos += 1
+                expect = "end"
+            elif expect == ",":
+                raise ValueError(f"Expected ',' or ']' in JSON array, got {buffer[pos]!r}")
+            else:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # Most likely an item cut off at the end of the chunk, wait for more text
+                    break
+
+                # A number at the very end may still be continuing in the next chunk
+                if end == len(buffer) and not isinstance(item, (dict, list, str)):
+                    break
+
+                yield item
+                pos = end
+                expect = ","
+
+        buffer = buffer[pos:]
+
+    if expect != "end":
+        raise ValueError("JSON array ended early" if expect != "[" else "Empty response, expected a JSON array")
+
+def stream_courses(url: str, term: str, *, cookies: dict[str, str], per_host: int | None = None, replay: bool = False) -> Iterator[dict]:
+    """
+    Catalog entries of url decoded as the response streams in
+    The catalog_fetch span runs from the request to the end of the stream, including time the consumer held it
+    """
+    start = time.perf_counter()
+
+    yield from iter_array(fetch.stream_text(
+        fetch.get_client(per_host),
+        archive.get_archive(),
+        url,
+        term,
+        cookies=cookies,
+        replay=replay,
+    ))
+
+    metrics.get_metrics().observe("catalog_fetch", time.perf_counter() - start)
+
+class CatalogIndex:
+    """
+    Catalog entries grouped by (department prefix, term)
+    """
+
+    def __init__(self, term: str):
+        self.term = term
+        self._courses: dict[tuple[str, str], list[dict]] = {}
+        self._departments: set[str] = set()
+
+    def add(self, course: dict):
+        """
+        Index a single catalog entry
+        """
+        self._courses.setdefault((dept_prefix(course), course["term"]), []).append(course)
+        self._departments.add(dept_prefix(course))
+
+    def covers(self, dept: str) -> bool:
+        """
+        True if the catalog had any entry of dept, in any term
+        """
+        return dept in self._departments
+
+    def slice(self, dept: str, term: str | None = None) -> list[dict]:
+        """
+        Catalog entries for one department, defaulting to the index term
+        """
+        return self._courses.get((dept, term or self.term), [])
+
+    def count(self, departments: list[str] | None = None, term: str | None = None) -> int:
+        """
+        Number of indexed courses for term, optionally limited to departments
+        """
+        term = term or self.term
+        return sum(
+            len(courses) for (dept, course_term), courses in self._courses.items()
+            if course_term == term and (departments is None or dept in departments)
+        )
+
+def main (
+    verbose: bool,
+    departments: list[str],
+    *,
+    per_host: int | None = None,
+    replay: bool = False,
+) -> tuple[bool, CatalogIndex | None]:
+    """
+    Request the full catalog a single time and index it by department and term
+    Departments the full catalog did not cover are requested one by one; any still missing
+    are left out of the index, so callers can tell them apart with covers
+    """
+
+    if not load_dotenv():
+        tqdm.write(const.err("Could not load .env"))
+        return False, None
+
+    endpoint = os.getenv("EXPOSED_ENDPOINT")
+
+    if not endpoint:
+        tqdm.write(const.err("Could not find EXPOSED_ENDPOINT in .env"))
+        return False, None
+
+    cookie = os.getenv("COOKIE")
+
+    if not cookie and not replay:
+        tqdm.write(const.err("Could not find COOKIE in .env"))
+        return False, None
+
+    term = os.getenv("TERM")
+
+    if not term:
+        tqdm.write(const.err("Could not find TERM in .env"))
+        return False, None
+
+    if verbose:
+        tqdm.write("Requesting full catalog...")
+
+    index = CatalogIndex(term)
+    cookies = {"csrftoken": cookie}
+
+    try:
+        # The endpoint is a prefix search, an empty query should return every department
+        for course in stream_courses(endpoint, term, cookies=cookies, per_host=per_host, replay=replay):
+            index.add(course)
+    except (IOError, ValueError, LookupError) as e:
+        tqdm.write(const.warning(f"Full catalog request failed, requesting departments one by one: {e}"))
+        index = CatalogIndex(term)
+
+    missing = [dept for dept in departments if not index.covers(dept)]
+
+    if missing and verbose:
+        tqdm.write(f"Full catalog did not cover {len(missing)} departments, requesting them one by one...")
+
+    for dept in missing:
+        try:
+            for course in stream_courses(endpoint + dept, term, cookies=cookies, per_host=per_host, replay=replay):
+                # A prefix search for CS also returns CSxx departments
+                if dept_prefix(course) == dept:
+                    index.add(course)
+        except (IOError, ValueError, LookupError) as e:
+            tqdm.write(const.warning(f"Catalog request failed for {dept}: {e}"))
+
+    if not any(index.covers(dept) for dept in departments):
+        tqdm.write(const.err("No response returned from API"))
+        return False, None
+
+    return True, index
@@ -6,20 +6,12 @@ import os
 import csv
 from typing import final
 from enum import Enum
-from tqdm import tqdm
-from uuid import uuid4
-from copy import deepcopy
 
 OUTPUT_PATH = "./output/"
 INPUT_PATH = "./input/"
 
 SCRAPE_OUTPUT_PATH = OUTPUT_PATH + 'scrape/'
 
-PERSONNEL_PATH = OUTPUT_PATH + 'personnel_rows.csv'
-CONDITIONS_PATH = OUTPUT_PATH + 'conditions_rows.csv'
-ASSESSMENTS_PATH = OUTPUT_PATH + 'assessments_rows.csv'
-ASSESSMENT_GROUPS_PATH = OUTPUT_PATH + 'assessment_groups_rows.csv'
-
 class OutlinesCols(Enum):
     """
     outlines table columns
@@ -39,8 +31,107 @@ outlines_columns = ["id", "code", "name", "description", "term", "url"]
 sections_columns = ["section", "course_id"]
 types_columns = ["type", "course_id"]
 
+# Column types for typed sinks, anything not listed is a string
+COLUMN_TYPES = {
+    "weight": "float64",
+    "count": "int64",
+    "drop": "int64",
+    "optional": "bool",
+    "index": "int64",
+    "scheme": "int64",
+    "lower": "float64",
+    "upper": "float64",
+}
+
+# Per department scrape tables, outlines last so a course only counts as covered once its child rows are on disk
+SCRAPE_TABLES = {
+    "personnels": personnels_columns,
+    "assessment_groups": assessment_groups_columns,
+    "assessments": assessments_columns,
+    "sections": sections_columns,
+    "types": types_columns,
+    "outlines": outlines_columns,
+}
+
 invalid_emails = ["a6lian@uwaterloo.ca"]
 
+#HTTP fetch layer
+FETCH_TIMEOUT = 60
+FETCH_RETRIES = 4
+FETCH_BACKOFF = 0.5
+FETCH_BACKOFF_CAP = 10
+FETCH_PER_HOST = 8
+FETCH_POOLS = 4
+FETCH_RETRY_STATUSES = (500, 502, 503, 504)
+#Bytes read at a time from streamed responses such as the catalog
+FETCH_STREAM_CHUNK = 64 * 1024
+
+# Tables split out of input/outlines_rows.csv by process_outlines
+PROCESS_TABLES = {
+    "personnel_rows": personnels_columns,
+    "conditions_rows": conditions_columns,
+    "assessments_rows": assessments_columns,
+    "assessment_groups_rows": assessment_groups_columns,
+}
+
+#Output sinks
+SINKS = ("csv", "parquet")
+SCRAPE_SINKS = SINKS + ("sqlite",)
+PARQUET_ROW_GROUP_SIZE = 50_000
+PARQUET_PART_COURSES = 250
+PARQUET_COMPRESSION = "zstd"
+SQLITE_PATH = OUTPUT_PATH + "scrape.sqlite3"
+SQLITE_BATCH_COURSES = 50
+SQLITE_BATCH_SECONDS = 30
+
+#Scrape pipeline
+PIPELINE_PARSE_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 64
+PIPELINE_POLL = 0.1
+
+#Outline dump processing
+PROCESS_CHUNK_SIZE = 4 * 1024 * 1024
+PROCESS_CHUNKS_PER_WORKER = 2
+
+#Weight parsing
+WEIGHT_CACHE_SIZE = 4096
+
+#Aggregation
+AGGREGATE_BUFFER_SIZE = 1024 * 1024
+AGGREGATE_MANIFEST_PATH = OUTPUT_PATH + "final/manifest.json"
+
+#Change detection between runs
+COURSE_MANIFEST_PATH = OUTPUT_PATH + "manifest.sqlite3"
+
+#Raw page archive
+ARCHIVE_PATH = OUTPUT_PATH + "archive.sqlite3"
+ARCHIVE_COMPRESSION = 6
+
+#LLM extraction
+GEMINI_MODEL = "gemini-2.5-flash"
+GEMINI_RPM = 1000
+GEMINI_TPM = 1_000_000
+LLM_MAX_CONCURRENCY = 16
+LLM_RETRIES = 5
+LLM_BACKOFF = 1
+LLM_BACKOFF_CAP = 60
+#Extractions submitted ahead of the oldest uncommitted course
+LLM_IN_FLIGHT = 32
+LLM_SLOT_POLL = 0.05
+#Rough prompt size in tokens is characters/4, plus this much for the response
+LLM_OUTPUT_TOKENS_ESTIMATE = 1024
+LLM_CACHE_PATH = OUTPUT_PATH + "llm_cache.sqlite3"
+LLM_CACHE_MAX_ENTRIES = 200_000
+LLM_CACHE_MAX_AGE_DAYS = 180
+BATCH_PATH = OUTPUT_PATH + "batch/"
+ASSESSMENT_RULES_MIN_CONFIDENCE = 0.9
+
+#Run metrics (--profile)
+METRICS_PATH = OUTPUT_PATH + "metrics/"
+METRICS_TEXTFILE = "doro_scrape.prom"
+METRICS_PREFIX = "doro_scrape"
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
 DEPARTMENTS = [
     "AE", "BME", "CHE", "CIVE", "ECE", "ME", "MSCI", "MSE", "MTE", "NE", "SE", "SYDE",
     "AMATH", "ACTSC", "CO", "CS", "MATH", "STAT",
@@ -85,31 +176,14 @@ def success(message: str) -> str:
     return f"{Colors.OKGREEN}SUCCESS: {message} {Colors.ENDC}"
 
 
-def count_rows(filename: str) -> tuple[bool, int | None]:
-    """
-    Generic function to count the number of rows in a CSV
-    """
-    num_rows = 0
-
-    try:
-        with open(INPUT_PATH+filename, "r", encoding="utf-8") as generic_csv:
-            counter_reader = csv.reader(generic_csv, lineterminator="\n")
-
-            for _ in counter_reader:
-                num_rows += 1
-
-    except IOError as e:
-        tqdm.write(err(str(e)))
-        return False, None
-
-    return True, num_rows
+#Prompts, the shared rule blocks keep the separate and combined calls in agreement
+PROMPT_JSON_RULE = "    - Output only JSON, no prose."
 
-def prompt(section_html: str):
-    return f"""
-    You are a strict parser.
+PERSONNEL_RULES = """\
+    - Role's should only be Professor or TA. No variance, if it doesn't fit then skip it.
+    - Courses can have no personnel, just return nothing"""
 
-    Rules:
-    - Output only JSON, no prose.
+ASSESSMENT_RULES = """\
     - Use absolute weights as decimals (e.g., 0.5 for 50%).
     - Create assessment GROUPS (e.g., "Quizzes") and ITEMS inside each group.
     - If a group has a total like "Quiz [50%]" and items like "[25%]":
@@ -121,8 +195,9 @@ def prompt(section_html: str):
     - group.drop: parse if present (e.g., "lowest two dropped"); otherwise 0.
     - If both undergraduate and graduate variants exist, prefer undergraduate unless the item is marked graduate-only (then optional=true).
     - Ensure the sum of item weights equals the group weight (±0.5%). If item weights aren’t provided, split group weight evenly.
-    - If dates are not directly parseable into a YYYY-MM-DD HH:mm:ss datetime format then use null, also year is always 2025
+    - If dates are not directly parseable into a YYYY-MM-DD HH:mm:ss datetime format then use null, also year is always 2025"""
 
+ASSESSMENT_EXAMPLE = """\
     Example (edge case):
     HTML snippet:
       Quiz [50%]
@@ -133,47 +208,75 @@ def prompt(section_html: str):
 
     Expectation:
     - 1 group "Quizzes" with weight 0.5 and count 4.
-    - 4 items with indexes 0..3 and weights 0.125 each, in the order they appear.
+    - 4 items with indexes 0..3 and weights 0.125 each, in the order they appear."""
+
+def prompt(section_html: str):
+    """
+    Returns the assessment parsing prompt for one section
+    """
+    return f"""
+    You are a strict parser.
+
+    Rules:
+{PROMPT_JSON_RULE}
+{ASSESSMENT_RULES}
+
+{ASSESSMENT_EXAMPLE}
 
     HTML to parse:
     {section_html}
     """
 
 def personnels_prompt(section_html: str):
+    """
+    Returns the personnel parsing prompt for one section
+    """
     return f"""
     You are a strict parser.
 
     Rules:
-    - Output only JSON, no prose.
-    - Role's should only be Professor or TA. No variance, if it doesn't fit then skip it.
-    - Courses can have no personnel, just return nothing
+{PROMPT_JSON_RULE}
+{PERSONNEL_RULES}
 
     HTML to parse:
     {section_html}
     """
 
+def course_prompt(personnels_html: str, assessments_html: str):
+    """
+    Returns the combined prompt for both sections of one course
+    """
+    return f"""
+    You are a strict parser. You are given two sections of the same course outline.
+    Fill "personnels" from the PERSONNEL section and "assessment_groups" / "assessments" from the ASSESSMENT section.
+    A section may be empty, in which case return an empty list for its fields.
+
+    Rules:
+{PROMPT_JSON_RULE}
 
-def assign_ids(parsed_output):
-    parsed = deepcopy(parsed_output)
+    Personnel rules:
+{PERSONNEL_RULES}
 
-    # map placeholder group_id -> real UUID
-    group_id_map = {}
+    Assessment rules:
+{ASSESSMENT_RULES}
 
-    for group in parsed.assessment_groups:
-        real_id = str(uuid4())
-        group_id_map[group.id] = real_id
-        group.id = real_id
+{ASSESSMENT_EXAMPLE}
 
-    # assign UUIDs to assessments and remap group_id
-    for idx, assessment in enumerate(parsed.assessments):
-        assessment.id = str(uuid4())
-        assessment.group_id = group_id_map.get(assessment.group_id, assessment.group_id)
+    PERSONNEL section HTML to parse:
+    {personnels_html}
+
+    ASSESSMENT section HTML to parse:
+    {assessments_html}
+    """
 
-    return parsed
 
 def open_csv_with_header(path: str, columns: list[str]):
+    """
+    Opens a CSV for appending, writing the header if it is new or empty
+    The caller owns the returned file and closes it
+    """
     file_exists = os.path.isfile(path)
-    csv_file = open(path, "a", encoding="utf-8", newline="")
+    csv_file = open(path, "a", encoding="utf-8", newline="") # pylint: disable=consider-using-with
     writer = csv.writer(csv_file, lineterminator="\n")
     if not file_exists or os.stat(path).st_size == 0:
         writer.writerow(columns)
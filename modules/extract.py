@@ -0,0 +1,316 @@
+"""
+Gemini extraction of personnel and assessments from outline sections
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+
+from google import genai
+
+from modules import constants as const
+from modules import metrics
+from modules import models
+from modules import records
+from modules import assessment_parser
+from modules import personnel_parser
+from modules.llm_cache import LLMCache
+from modules.llm_control import LLMController, RetryableResponse
+
+_client: genai.Client | None = None # pylint: disable=invalid-name
+_client_lock = threading.Lock()
+
+def get_client(api_key: str) -> genai.Client:
+    """
+    Returns the process wide Gemini client, creating it on first use
+    GEMINI_BASE_URL points it at another endpoint, e.g. modules.fake_gemini
+    """
+    global _client # pylint: disable=global-statement
+
+    with _client_lock:
+        if _client is None:
+            base_url = os.getenv("GEMINI_BASE_URL")
+            _client = genai.Client(api_key=api_key, http_options={"base_url": base_url} if base_url else None)
+
+    return _client
+
+RESPONSE_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": models.ParsedCourseOutput,
+}
+
+def cache_key(personnels_html: str, assessments_html: str) -> str:
+    """
+    LLM cache key of one course's extraction request
+    """
+    return LLMCache.key(
+        [personnels_html, assessments_html],
+        const.course_prompt("{personnels_html}", "{assessments_html}"),
+        models.ParsedCourseOutput,
+        const.GEMINI_MODEL,
+    )
+
+def _checked(response):
+    """
+    Pass a response through, treating one without a parsed value as retryable
+    """
+    if response.parsed is None:
+        raise RetryableResponse("Gemini returned no parsable response")
+    return response
+
+def _used_tokens(response) -> int | None:
+    return response.usage_metadata.total_token_count if response.usage_metadata else None
+
+def _record_usage(response):
+    """
+    Count a response's input, output and thinking tokens
+    """
+    usage = response.usage_metadata
+
+    if usage is None:
+        return
+
+    run_metrics = metrics.get_metrics()
+    run_metrics.count("llm_tokens", usage.prompt_token_count or 0, kind="input")
+    run_metrics.count("llm_tokens", usage.candidates_token_count or 0, kind="output")
+    run_metrics.count("llm_tokens", usage.thoughts_token_count or 0, kind="thinking")
+
+def _cached(cache: LLMCache | None, key: str) -> records.CourseRecords | None:
+    """
+    Cached extraction for key, counting the lookup
+    """
+    if cache is None:
+        return None
+
+    cached = cache.get(key, records.CourseRecords.from_json)
+    metrics.get_metrics().count("llm_cache", result="miss" if cached is None else "hit")
+
+    return cached
+
+def _estimated_tokens(contents: str) -> int:
+    return len(contents) // 4 + const.LLM_OUTPUT_TOKENS_ESTIMATE
+
+def generate(
+    client: genai.Client,
+    personnels_html: str,
+    assessments_html: str,
+    controller: LLMController,
+    cache: LLMCache | None = None,
+) -> records.CourseRecords:
+    """
+    Extract personnel and assessments for one course in a single structured-output call
+    Returns an empty output when both sections are empty
+    Raises llm_control.LLMCallFailed when Gemini kept failing or giving no parsable response
+    """
+    if not personnels_html and not assessments_html:
+        return records.CourseRecords()
+
+    key = cache_key(personnels_html, assessments_html) if cache is not None else ""
+    cached = _cached(cache, key)
+
+    if cached is not None:
+        return cached
+
+    contents = const.course_prompt(personnels_html, assessments_html)
+
+    response = controller.call(
+        lambda: _checked(client.models.generate_content(
+            model=const.GEMINI_MODEL, contents=contents, config=RESPONSE_CONFIG
+        )),
+        _estimated_tokens(contents),
+        _used_tokens,
+    )
+
+    _record_usage(response)
+    extracted = records.CourseRecords.from_model(response.parsed)
+
+    if cache is not None:
+        cache.put(key, const.GEMINI_MODEL, extracted.to_json())
+
+    return extracted
+
+async def generate_async(
+    client: genai.Client,
+    personnels_html: str,
+    assessments_html: str,
+    controller: LLMController,
+    cache: LLMCache | None = None,
+) -> records.CourseRecords:
+    """
+    generate on the SDK's async client
+    """
+    if not personnels_html and not assessments_html:
+        return records.CourseRecords()
+
+    key = cache_key(personnels_html, assessments_html) if cache is not None else ""
+    cached = _cached(cache, key)
+
+    if cached is not None:
+        return cached
+
+    contents = const.course_prompt(personnels_html, assessments_html)
+
+    async def call():
+        return _checked(await client.aio.models.generate_content(
+            model=const.GEMINI_MODEL, contents=contents, config=RESPONSE_CONFIG
+        ))
+
+    response = await controller.call_async(call, _estimated_tokens(contents), _used_tokens)
+
+    _record_usage(response)
+    extracted = records.CourseRecords.from_model(response.parsed)
+
+    if cache is not None:
+        cache.put(key, const.GEMINI_MODEL, extracted.to_json())
+
+    return extracted
+
+def local_sections(
+    personnels_html: str,
+    assessments_html: str,
+    use_rules: bool,
+) -> tuple[records.CourseRecords | None, records.CourseRecords | None]:
+    """
+    Personnel and assessments the local parsers handle confidently, None where Gemini is needed
+    """
+    local_personnels = None
+    local_assessments = None
+
+    if use_rules and assessments_html:
+        parsed, confidence = assessment_parser.parse(assessments_html)
+
+        if parsed is not None and confidence >= const.ASSESSMENT_RULES_MIN_CONFIDENCE:
+            local_assessments = parsed
+
+    if use_rules and personnels_html:
+        local_personnels = personnel_parser.parse(personnels_html)
+
+    return local_personnels, local_assessments
+
+def merge_local(
+    extracted: records.CourseRecords,
+    local_personnels: records.CourseRecords | None,
+    local_assessments: records.CourseRecords | None,
+) -> records.CourseRecords:
+    """
+    Replace the parts of extracted that the local parsers handled
+    """
+    if local_assessments is not None:
+        extracted.assessment_groups = local_assessments.assessment_groups
+        extracted.assessments = local_assessments.assessments
+
+    if local_personnels is not None:
+        extracted.personnels = local_personnels.personnels
+
+    return extracted
+
+def extract_course(
+    client: genai.Client,
+    personnels_html: str,
+    assessments_html: str,
+    controller: LLMController,
+    *,
+    cache: LLMCache | None = None,
+    use_rules: bool = True,
+) -> records.CourseRecords:
+    """
+    Extract personnel and assessments for one course
+    Sections the local parsers handle confidently are left out of the Gemini call
+    """
+    local_personnels, local_assessments = local_sections(personnels_html, assessments_html, use_rules)
+
+    extracted = generate(
+        client,
+        "" if local_personnels else personnels_html,
+        "" if local_assessments else assessments_html,
+        controller,
+        cache,
+    )
+
+    return merge_local(extracted, local_personnels, local_assessments)
+
+async def extract_course_async(
+    client: genai.Client,
+    personnels_html: str,
+    assessments_html: str,
+    controller: LLMController,
+    *,
+    cache: LLMCache | None = None,
+    use_rules: bool = True,
+) -> records.CourseRecords:
+    """
+    extract_course on the SDK's async client
+    """
+    local_personnels, local_assessments = local_sections(personnels_html, assessments_html, use_rules)
+
+    extracted = await generate_async(
+        client,
+        "" if local_personnels else personnels_html,
+        "" if local_assessments else assessments_html,
+        controller,
+        cache,
+    )
+
+    return merge_local(extracted, local_personnels, local_assessments)
+
+class AsyncExtractor:
+    """
+    Runs course extractions concurrently on an event loop in a background thread
+    submit() blocks once in_flight extractions are pending, so callers stay bounded
+    """
+
+    def __init__(
+        self,
+        client: genai.Client,
+        controller: LLMController,
+        *,
+        cache: LLMCache | None = None,
+        use_rules: bool = True,
+        in_flight: int = const.LLM_IN_FLIGHT,
+    ):
+        self.options = {"cache": cache, "use_rules": use_rules}
+        self.client = client
+        self.controller = controller
+
+        self._slots = threading.BoundedSemaphore(in_flight)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-extract", daemon=True)
+        self._thread.start()
+
+    def submit(self, personnels_html: str, assessments_html: str) -> Future:
+        """
+        Start extracting one course, the future resolves to its records
+        """
+        self._slots.acquire() # pylint: disable=consider-using-with
+
+        future = asyncio.run_coroutine_threadsafe(
+            extract_course_async(self.client, personnels_html, assessments_html, self.controller, **self.options),
+            self._loop,
+        )
+        future.add_done_callback(lambda _: self._slots.release())
+
+        return future
+
+    def close(self):
+        """
+        Stop the event loop, cancelling anything still running
+        """
+        async def cancel_pending():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self._loop.is_running():
+            asyncio.run_coroutine_threadsafe(cancel_pending(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -0,0 +1,191 @@
+"""
+Local stand-in for the Gemini generateContent endpoint and batch jobs
+Injects throttling, server errors, unparsable responses and latency so the LLM controller
+can be exercised without spending quota. Point the scraper at it with
+GEMINI_BASE_URL=http://127.0.0.1:<port>
+With --batch it instead answers a batch requests file offline, for batch ingest
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tqdm import tqdm
+
+from modules import constants as const
+
+RESPONSE = {
+    "personnels": [{"course_id": None, "name": "Jane Doe", "role": "Professor", "email": "jdoe@uwaterloo.ca"}],
+    "assessment_groups": [
+        {"id": "G1", "course_id": None, "weight": 1.0, "count": 1, "drop": 0, "name": "Final", "optional": False}
+    ],
+    "assessments": [{"id": None, "group_id": "G1", "weight": 1.0, "index": 0, "due_date": None, "name": "Final"}],
+}
+
+def response_body(prompt_tokens: int, unparsed: bool) -> dict:
+    """
+    GenerateContentResponse JSON with the canned extraction
+    """
+    text = "Sorry, I can't help with that." if unparsed else json.dumps(RESPONSE)
+    output_tokens = len(text) // 4
+
+    return {
+        "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+        "usageMetadata": {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": output_tokens,
+            "totalTokenCount": prompt_tokens + output_tokens,
+        },
+    }
+
+def answer_batch(requests_path: str, results_path: str, options: argparse.Namespace) -> dict[str, int]:
+    """
+    Write a batch output file for a batch input file, failing lines at the injected rates
+    Returns the number of lines by outcome
+    """
+    counts: dict[str, int] = {}
+
+    with (
+        open(requests_path, "r", encoding="utf-8") as requests_file,
+        open(results_path, "w", encoding="utf-8") as results_file,
+    ):
+        for line in requests_file:
+            if not line.strip():
+                continue
+
+            request = json.loads(line)
+            roll = random.random()
+
+            if roll < options.error_rate:
+                outcome = "error"
+                result = {"key": request["key"], "error": {"code": 500, "message": "Internal error", "status": "INTERNAL"}}
+            else:
+                outcome = "unparsed" if roll < options.error_rate + options.unparsed_rate else "ok"
+                result = {"key": request["key"], "response": response_body(len(line) // 4, outcome == "unparsed")}
+
+            counts[outcome] = counts.get(outcome, 0) + 1
+            results_file.write(json.dumps(result) + "\n")
+
+    return counts
+
+class FakeGemini(ThreadingHTTPServer):
+    """
+    Server holding the fault injection settings and request counters
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], options: argparse.Namespace):
+        super().__init__(address, Handler)
+        self.options = options
+        self.counts: dict[str, int] = {}
+        self.recent: deque[float] = deque()
+        self.lock = threading.Lock()
+
+    def outcome(self) -> str:
+        """
+        Decide how to answer the next request
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            while self.recent and now - self.recent[0] > 60:
+                self.recent.popleft()
+
+            if self.options.rpm and len(self.recent) >= self.options.rpm:
+                outcome = "quota"
+            else:
+                self.recent.append(now)
+                roll = random.random()
+                if roll < self.options.throttle_rate:
+                    outcome = "throttled"
+                elif roll < self.options.throttle_rate + self.options.error_rate:
+                    outcome = "server_error"
+                elif roll < self.options.throttle_rate + self.options.error_rate + self.options.unparsed_rate:
+                    outcome = "unparsed"
+                else:
+                    outcome = "ok"
+
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+
+        return outcome
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Answers POST .../models/<model>:generateContent
+    """
+    server: FakeGemini
+
+    def _send(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """
+        Reply with a canned extraction or an injected failure
+        """
+        request = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if not self.path.endswith(":generateContent"):
+            self._send(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+            return
+
+        outcome = self.server.outcome()
+
+        if self.server.options.delay:
+            time.sleep(random.expovariate(1 / self.server.options.delay))
+
+        if outcome in ("throttled", "quota"):
+            self._send(429, {"error": {"code": 429, "message": "Resource exhausted", "status": "RESOURCE_EXHAUSTED"}})
+            return
+
+        if outcome == "server_error":
+            self._send(503, {"error": {"code": 503, "message": "Unavailable", "status": "UNAVAILABLE"}})
+            return
+
+        self._send(200, response_body(len(request) // 4, outcome == "unparsed"))
+
+    def log_message(self, format, *log_args): # pylint: disable=redefined-builtin
+        pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fake Gemini endpoint with fault injection"
+    )
+
+    _ = parser.add_argument("--port", type=int, default=8900, help="Port to listen on")
+    _ = parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    _ = parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    _ = parser.add_argument("--unparsed-rate", type=float, default=0.0, help="Fraction of responses that are not JSON")
+    _ = parser.add_argument("--rpm", type=int, default=0, help="Requests per minute before every request gets 429, 0 for no quota")
+    _ = parser.add_argument("--delay", type=float, default=0.0, help="Mean response latency in seconds")
+    _ = parser.add_argument(
+        "--batch",
+        nargs=2,
+        metavar=("REQUESTS", "RESULTS"),
+        help="Answer a batch requests file into a results file instead of serving"
+    )
+
+    args: argparse.Namespace = parser.parse_args()
+
+    if args.batch:
+        tqdm.write(const.success(f"Batch lines by outcome: {answer_batch(*args.batch, args)}"))
+        raise SystemExit(0)
+
+    server = FakeGemini(("127.0.0.1", args.port), args)
+    tqdm.write(f"Fake Gemini listening on http://127.0.0.1:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        tqdm.write(const.success(f"Requests by outcome: {server.counts}"))
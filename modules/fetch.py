@@ -0,0 +1,285 @@
+"""
+Shared HTTP fetch layer for the catalog API and outline pages
+"""
+
+import codecs
+import random
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Iterator
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from modules import constants as const
+from modules import metrics
+from modules.archive import PageArchive
+
+class FetchClient:
+    """
+    Pooled keep-alive session with a per-host concurrency cap, timeouts and jittered retries
+    """
+
+    def __init__(
+        self,
+        per_host: int = const.FETCH_PER_HOST,
+        timeout: float = const.FETCH_TIMEOUT,
+        retries: int = const.FETCH_RETRIES,
+        backoff: float = const.FETCH_BACKOFF,
+    ):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        # Retries are handled below so they can share the host slots and jitter
+        adapter = HTTPAdapter(pool_connections=const.FETCH_POOLS, pool_maxsize=per_host, max_retries=0)
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._hosts: dict[str, threading.BoundedSemaphore] = {}
+        self._hosts_lock = threading.Lock()
+
+    @contextmanager
+    def _host_slot(self, url: str):
+        """
+        Block until the host of url has a free connection slot
+        """
+        host = urlsplit(url).netloc.lower()
+
+        with self._hosts_lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            slot = self._hosts[host]
+
+        with slot:
+            yield
+
+    def _wait(self, attempt: int):
+        """
+        Full-jitter exponential backoff
+        """
+        time.sleep(random.uniform(0, min(const.FETCH_BACKOFF_CAP, self.backoff * 2 ** attempt)))
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        GET url through the pool, retrying on 5xx, connection resets and timeouts
+        """
+        kwargs.setdefault("timeout", self.timeout)
+
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+
+            try:
+                with self._host_slot(url):
+                    response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.get_metrics().count("http_errors", error=type(e).__name__)
+                if last_attempt:
+                    raise
+                self._wait(attempt)
+                continue
+
+            metrics.get_metrics().count("http_responses", status=response.status_code)
+
+            if response.status_code in const.FETCH_RETRY_STATUSES and not last_attempt:
+                response.close()
+                self._wait(attempt)
+                continue
+
+            return response
+
+        raise requests.RequestException(f"Exhausted retries for {url}")
+
+    def close(self):
+        """
+        Close all pooled connections
+        """
+        self.session.close()
+
+
+_client: FetchClient | None = None # pylint: disable=invalid-name
+_client_lock = threading.Lock()
+
+def get_client(per_host: int | None = None) -> FetchClient:
+    """
+    Returns the process wide FetchClient, creating it on first use
+    """
+    global _client # pylint: disable=global-statement
+
+    with _client_lock:
+        if _client is None:
+            _client = FetchClient(per_host=per_host or const.FETCH_PER_HOST)
+
+    return _client
+
+def close_client():
+    """
+    Close and forget the process wide FetchClient, so forked workers open their own
+    """
+    global _client # pylint: disable=global-statement
+
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+def normalize_url(url: str) -> str:
+    """
+    Canonical form of an outline url, so spellings of the same page compare equal
+    Lowercases the scheme and host, drops default ports, fragments and a trailing slash, and sorts the query
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+
+    if parts.port and (scheme, parts.port) not in (("http", 80), ("https", 443)):
+        host = f"{host}:{parts.port}"
+
+    path = parts.path.rstrip("/")
+    if host and not path:
+        path = "/"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+
+    return urlunsplit((scheme, host, path, query, ""))
+
+def fetch_page(
+    fetcher: FetchClient,
+    pages: PageArchive,
+    url: str,
+    term: str,
+    *,
+    cookies: dict[str, str],
+    replay: bool,
+    validators: dict[str, str] | None = None,
+    fresh_since: float | None = None,
+) -> tuple[int, str, dict[str, str]]:
+    """
+    Returns (status, text, validators) for url, from the archive in replay mode and from the network otherwise
+    validators are the ETag and Last-Modified of an earlier fetch, sent as a conditional request;
+    a 304 comes back with empty text and the validators it was asked with
+    fresh_since reuses a successful snapshot archived at or after that time instead of fetching, so
+    pages shared between departments are only fetched once per sweep
+    Live responses other than 304 are archived as they are fetched
+    """
+    run_metrics = metrics.get_metrics()
+
+    if replay:
+        archived = pages.latest(url, term)
+
+        if archived is None:
+            raise LookupError(f"{url} is not in the archive")
+
+        run_metrics.count("pages", source="replay")
+        return *archived, {}
+
+    if fresh_since is not None:
+        archived = pages.latest(url, term, since=fresh_since)
+
+        if archived is not None and archived[0] == 200:
+            run_metrics.count("pages", source="archive")
+            return *archived, {}
+
+    headers = {}
+    if validators and validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators and validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    with run_metrics.span("page_fetch"):
+        response = fetcher.get(url, cookies=cookies, headers=headers)
+        body = response.content
+
+    run_metrics.count("http_bytes", len(body), kind="page")
+
+    if response.status_code == 304:
+        run_metrics.count("pages", source="not_modified")
+        return 304, "", dict(validators or {})
+
+    run_metrics.count("pages", source="network")
+
+    pages.put(url, term, response.status_code, response.text)
+
+    response_validators = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+    return response.status_code, response.text, {key: value for key, value in response_validators.items() if value}
+
+def fetch_text(fetcher: FetchClient, pages: PageArchive, url: str, term: str, *, cookies: dict[str, str], replay: bool) -> tuple[int, str]:
+    """
+    Returns (status, text) for url, from the archive in replay mode and from the network otherwise
+    Live responses are archived as they are fetched
+    """
+    status, text, _ = fetch_page(fetcher, pages, url, term, cookies=cookies, replay=replay)
+
+    return status, text
+
+def _arriving(response: requests.Response) -> Iterator[bytes]:
+    """
+    Body of a streamed response in pieces as they arrive, then one empty piece
+    iter_content would block until a whole FETCH_STREAM_CHUNK is buffered, holding back a small catalog
+    """
+    read1 = getattr(response.raw, "read1", None)
+
+    if read1 is None:
+        # urllib3 before 2.0
+        yield from response.iter_content(chunk_size=const.FETCH_STREAM_CHUNK)
+    else:
+        while body := read1(const.FETCH_STREAM_CHUNK, decode_content=True):
+            yield body
+
+    yield b""
+
+def stream_text(fetcher: FetchClient, pages: PageArchive, url: str, term: str, *, cookies: dict[str, str], replay: bool) -> Iterator[str]:
+    """
+    Yields the text of url in chunks as it downloads, or as it decompresses from the archive when replaying
+    A live response is compressed alongside and archived once it has been read to the end
+    Raises IOError for anything but a 200
+    """
+    if replay:
+        archived = pages.iter_latest(url, term)
+
+        if archived is None:
+            raise LookupError(f"{url} is not in the archive")
+
+        status, chunks = archived
+
+        if status != 200:
+            raise IOError(f"{url} returned {status}")
+
+        yield from chunks
+        return
+
+    response = fetcher.get(url, cookies=cookies, stream=True)
+
+    # JSON has no charset parameter
+    response.encoding = response.encoding or "utf-8"
+
+    if response.status_code != 200:
+        pages.put(url, term, response.status_code, response.text)
+        raise IOError(f"{url} returned {response.status_code}")
+
+    decoder = codecs.getincrementaldecoder(response.encoding)(errors="replace")
+    compressor = zlib.compressobj(const.ARCHIVE_COMPRESSION)
+    compressed = []
+
+    try:
+        for body in _arriving(response):
+            metrics.get_metrics().count("http_bytes", len(body), kind="stream")
+            chunk = decoder.decode(body, final=not body)
+            compressed.append(compressor.compress(chunk.encode("utf-8")))
+
+            if chunk:
+                yield chunk
+    finally:
+        response.close()
+
+    compressed.append(compressor.flush())
+    pages.put_compressed(url, term, response.status_code, b"".join(compressed))
@@ -0,0 +1,162 @@
+"""
+Crash-safe per-course writes to a department's scrape output
+"""
+
+import csv
+import json
+import os
+
+from tqdm import tqdm
+
+from modules import constants as const
+
+class CourseJournal:
+    """
+    Appends all six tables for a course as one unit
+    Before a course is written, the current size of every table is recorded in a
+    pending marker. If the process dies mid-course the marker is still there on the
+    next start and every table is truncated back to those sizes, so no orphan rows survive.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.pending_path = os.path.join(directory, "journal.pending")
+
+        self.recover()
+
+        self._files = {}
+        self._writers = {}
+
+        for table, columns in const.SCRAPE_TABLES.items():
+            csv_file, writer = const.open_csv_with_header(self.path(table), columns)
+            csv_file.flush()
+            self._files[table] = csv_file
+            self._writers[table] = writer
+
+    def path(self, table: str) -> str:
+        """
+        CSV path of table in this department
+        """
+        return os.path.join(self.directory, f"{table}.csv")
+
+    def recover(self) -> bool:
+        """
+        Roll back a course left half written by a crash
+        Returns True when a rollback happened
+        """
+        if not os.path.isfile(self.pending_path):
+            return False
+
+        with open(self.pending_path, "r", encoding="utf-8") as pending:
+            try:
+                offsets = json.load(pending)
+            except ValueError:
+                # The marker itself was cut short, so no table was touched yet
+                offsets = {}
+
+        for table, offset in offsets.items():
+            path = self.path(table)
+            if os.path.isfile(path) and os.path.getsize(path) > offset:
+                with open(path, "r+b") as table_file:
+                    table_file.truncate(offset)
+
+        os.remove(self.pending_path)
+        tqdm.write(const.warning(f"Rolled back an incomplete course in {self.directory}"))
+
+        return True
+
+    def completed_codes(self) -> set[str]:
+        """
+        Course codes already committed to outlines.csv
+        """
+        with open(self.path("outlines"), "r", encoding="utf-8", newline="") as outlines_csv:
+            reader = csv.reader(outlines_csv)
+            next(reader, None)
+            return {row[1] for row in reader if len(row) > 1}
+
+    def commit(self, rows: dict[str, list[list]]):
+        """
+        Append every table's rows for one course, outlines last
+        """
+        offsets = {}
+        for table, csv_file in self._files.items():
+            csv_file.flush()
+            offsets[table] = os.fstat(csv_file.fileno()).st_size
+
+        temp_path = self.pending_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as pending:
+            json.dump(offsets, pending)
+            pending.flush()
+            os.fsync(pending.fileno())
+        os.replace(temp_path, self.pending_path)
+
+        for table, csv_file in self._files.items():
+            self._writers[table].writerows(rows.get(table, []))
+            csv_file.flush()
+            os.fsync(csv_file.fileno())
+
+        os.remove(self.pending_path)
+
+    def close(self):
+        """
+        Close every table
+        """
+        for csv_file in self._files.values():
+            csv_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+def compact(directory: str) -> int:
+    """
+    Drop superseded courses from a closed department journal
+    A course committed again (e.g. by a delta run) is appended after its old rows, so only the
+    last outlines row of each code is kept, then every child row not reachable from a kept
+    outline. Outlines are rewritten first so a crash part way only leaves orphans, which the
+    next compaction removes. Returns the number of rows dropped
+    """
+    def read(table: str) -> list[list[str]]:
+        with open(os.path.join(directory, f"{table}.csv"), "r", encoding="utf-8", newline="") as table_csv:
+            reader = csv.reader(table_csv)
+            next(reader, None)
+            return list(reader)
+
+    def rewrite(table: str, rows: list[list[str]], kept: list[list[str]]) -> int:
+        if len(kept) == len(rows):
+            return 0
+
+        path = os.path.join(directory, f"{table}.csv")
+
+        with open(path + ".tmp", "w", encoding="utf-8", newline="") as table_csv:
+            writer = csv.writer(table_csv, lineterminator="\n")
+            writer.writerow(const.SCRAPE_TABLES[table])
+            writer.writerows(kept)
+
+        os.replace(path + ".tmp", path)
+
+        return len(rows) - len(kept)
+
+    outlines = read("outlines")
+    latest = {row[1]: row[0] for row in outlines if len(row) > 1}
+    course_ids = set(latest.values())
+    dropped = rewrite("outlines", outlines, [row for row in outlines if len(row) > 1 and latest[row[1]] == row[0]])
+
+    group_ids = set()
+
+    for table in ("personnels", "assessment_groups", "sections", "types"):
+        rows = read(table)
+        position = const.SCRAPE_TABLES[table].index("course_id")
+        kept = [row for row in rows if len(row) > position and row[position] in course_ids]
+
+        if table == "assessment_groups":
+            group_ids = {row[0] for row in kept}
+
+        dropped += rewrite(table, rows, kept)
+
+    assessments = read("assessments")
+    dropped += rewrite("assessments", assessments, [row for row in assessments if len(row) > 1 and row[1] in group_ids])
+
+    return dropped
@@ -0,0 +1,161 @@
+"""
+Content-addressed on-disk cache for LLM extraction results
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, TypeVar
+
+from pydantic import BaseModel
+
+from modules import constants as const
+
+T = TypeVar("T")
+
+class LLMCache:
+    """
+    SQLite backed cache of parsed Gemini responses
+    Keys hash the section HTML, prompt template, response schema and model name so
+    any change to one of them is a miss. Entries are evicted by age and total count.
+    """
+
+    def __init__(
+        self,
+        path: str = const.LLM_CACHE_PATH,
+        max_entries: int = const.LLM_CACHE_MAX_ENTRIES,
+        max_age_days: float = const.LLM_CACHE_MAX_AGE_DAYS,
+    ):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+        self._conn.commit()
+
+        self.evict()
+
+    @staticmethod
+    def key(sections: list[str], template: str, schema: type[BaseModel], model: str) -> str:
+        """
+        Content hash identifying one extraction request
+        """
+        payload = json.dumps(
+            [sections, template, schema.model_json_schema(), model],
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str, decode: Callable[[str], T]) -> T | None:
+        """
+        Returns the cached output for key passed through decode, or None on a miss
+        """
+        now = time.time()
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None or now - row[1] > self.max_age:
+                self.misses += 1
+                return None
+
+            self._conn.execute(
+                "UPDATE llm_cache SET accessed = ?, hits = hits + 1 WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+
+        return decode(row[0])
+
+    def put(self, key: str, model: str, value: str):
+        """
+        Store a parsed output's JSON under key
+        """
+        now = time.time()
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, model, value, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, model, value, now, now),
+            )
+            self._conn.commit()
+
+    def evict(self) -> int:
+        """
+        Drop expired entries, then the least recently used ones above max_entries
+        Returns the number of evicted entries
+        """
+        with self._lock:
+            expired = self._conn.execute(
+                "DELETE FROM llm_cache WHERE created < ?", (time.time() - self.max_age,)
+            ).rowcount
+
+            overflow = self._conn.execute(
+                """
+                DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            ).rowcount
+
+            self._conn.commit()
+
+        return expired + overflow
+
+    def stats(self) -> str:
+        """
+        Human readable hit/miss counters
+        """
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.0%} hit rate)"
+
+    def close(self):
+        """
+        Close the underlying connection
+        """
+        with self._lock:
+            self._conn.close()
+
+
+_cache: LLMCache | None = None # pylint: disable=invalid-name
+_cache_lock = threading.Lock()
+
+def get_cache() -> LLMCache:
+    """
+    Returns the process wide LLMCache, opening it on first use
+    """
+    global _cache # pylint: disable=global-statement
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMCache()
+
+    return _cache
@@ -0,0 +1,317 @@
+"""
+Rate limiting, adaptive concurrency and retries for Gemini calls
+"""
+
+import asyncio
+import random
+import threading
+import time
+from typing import Awaitable, Callable, TypeVar
+
+import httpx
+from google.genai import errors
+
+from modules import constants as const
+from modules import metrics
+
+T = TypeVar("T")
+
+class TokenBucket:
+    """
+    Refills rate_per_minute units per minute up to one minute's worth
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60
+        self.capacity = rate_per_minute
+        self._level = rate_per_minute
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self, amount: float) -> float:
+        """
+        Take amount units if available, otherwise return how long to wait for them
+        Requests larger than the bucket only wait for a full bucket
+        """
+        amount = min(amount, self.capacity)
+
+        with self._lock:
+            self._refill(time.monotonic())
+
+            if self._level >= amount:
+                self._level -= amount
+                return 0.0
+
+            return (amount - self._level) / self.rate
+
+    def acquire(self, amount: float):
+        """
+        Block until amount units are available, then take them
+        """
+        while wait := self._take(amount):
+            time.sleep(wait)
+
+    async def acquire_async(self, amount: float):
+        """
+        acquire without blocking the event loop
+        """
+        while wait := self._take(amount):
+            await asyncio.sleep(wait)
+
+    def adjust(self, amount: float):
+        """
+        Correct an earlier estimate once the real cost is known, may go negative
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self._level -= amount
+
+class RetryableResponse(Exception):
+    """
+    A call returned but its result is unusable (e.g. response.parsed is None)
+    """
+
+class LLMCallFailed(Exception):
+    """
+    A call still failed with a retryable error after every retry
+    """
+
+class AdaptiveLimit:
+    """
+    In-flight limit that follows AIMD: each success adds 1/limit, each throttled call halves it
+    """
+
+    def __init__(self, maximum: int):
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self._in_flight = 0
+        self._changed = threading.Condition()
+
+    def acquire(self):
+        """
+        Block until fewer than limit calls are in flight
+        """
+        with self._changed:
+            while self._in_flight >= int(self.limit):
+                self._changed.wait()
+            self._in_flight += 1
+
+    async def acquire_async(self):
+        """
+        acquire without blocking the event loop, polling since the limit is shared with threads
+        """
+        while True:
+            with self._changed:
+                if self._in_flight < int(self.limit):
+                    self._in_flight += 1
+                    return
+
+            await asyncio.sleep(const.LLM_SLOT_POLL)
+
+    def release(self, throttled: bool):
+        """
+        Finish a call and adapt the limit to how it went
+        """
+        with self._changed:
+            self._in_flight -= 1
+
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+
+            self._changed.notify_all()
+
+class CallMetrics:
+    """
+    Outcome counts and latencies of finished calls
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._outcomes: dict[str, int] = {}
+        self._latencies: list[float] = []
+
+    def record(self, outcome: str, latency: float):
+        """
+        Count one finished call
+        """
+        with self._lock:
+            self._outcomes[outcome] = self._outcomes.get(outcome, 0) + 1
+            self._latencies.append(latency)
+
+        metrics.get_metrics().observe("llm_call", latency, outcome=outcome)
+
+    def snapshot(self) -> dict:
+        """
+        Call counts by outcome and latency percentiles
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            outcomes = dict(self._outcomes)
+
+        def percentile(p: float) -> float:
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+
+        return {
+            "calls": len(latencies),
+            "outcomes": outcomes,
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "max": latencies[-1] if latencies else 0.0,
+        }
+
+class LLMController:
+    """
+    Shared gate for every Gemini call in the process
+    Requests and tokens per minute are token buckets and concurrency is an AIMD limit.
+    Throttled, server side and unusable responses are retried with full-jitter exponential backoff.
+    """
+
+    def __init__(
+        self,
+        rpm: float = const.GEMINI_RPM,
+        tpm: float = const.GEMINI_TPM,
+        max_concurrency: int = const.LLM_MAX_CONCURRENCY,
+        retries: int = const.LLM_RETRIES,
+    ):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = AdaptiveLimit(max_concurrency)
+        self.retries = retries
+        self.metrics = CallMetrics()
+
+    @staticmethod
+    def _classify(error: Exception) -> str | None:
+        """
+        Outcome name for a retryable error, None if the error should propagate
+        """
+        if isinstance(error, RetryableResponse):
+            return "unparsed"
+        if isinstance(error, errors.APIError) and error.code == 429:
+            return "throttled"
+        if isinstance(error, errors.ServerError):
+            return "server_error"
+        if isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError)):
+            return "connection_error"
+        return None
+
+    def _throttled(self, error: Exception | None) -> bool:
+        return error is not None and self._classify(error) == "throttled"
+
+    def _failed(self, error: Exception, attempt: int, start: float) -> float:
+        """
+        Account for a failed attempt and return the backoff before the next one
+        Raises when the error is not retryable or this was the last attempt
+        """
+        outcome = self._classify(error) or "error"
+
+        self.metrics.record(outcome, time.perf_counter() - start)
+
+        if outcome == "error":
+            raise error
+        if attempt == self.retries:
+            raise LLMCallFailed(f"{outcome} after {attempt + 1} attempts: {error}") from error
+
+        return random.uniform(0, min(const.LLM_BACKOFF_CAP, const.LLM_BACKOFF * 2 ** attempt))
+
+    def _succeeded(self, used: int | None, estimated_tokens: int, start: float):
+        """
+        Account for a successful attempt
+        """
+        self.metrics.record("ok", time.perf_counter() - start)
+
+        if used:
+            self.tokens.adjust(used - estimated_tokens)
+
+    def call(self, fn: Callable[[], T], estimated_tokens: int, used_tokens: Callable[[T], int | None]) -> T:
+        """
+        Run fn under the limits, retrying throttled and transient failures
+        used_tokens reports the real token count of a result to settle the estimate
+        Raises LLMCallFailed once retries are exhausted, other errors propagate immediately
+        """
+        for attempt in range(self.retries + 1):
+            self.requests.acquire(1)
+            self.tokens.acquire(estimated_tokens)
+            self.concurrency.acquire()
+            start = time.perf_counter()
+            error = None
+
+            try:
+                result = fn()
+            except Exception as e: # pylint: disable=broad-exception-caught
+                error = e
+            finally:
+                self.concurrency.release(self._throttled(error))
+
+            if error is not None:
+                time.sleep(self._failed(error, attempt, start))
+                continue
+
+            self._succeeded(used_tokens(result), estimated_tokens, start)
+            return result
+
+        raise AssertionError("unreachable")
+
+    async def call_async(
+        self,
+        fn: Callable[[], Awaitable[T]],
+        estimated_tokens: int,
+        used_tokens: Callable[[T], int | None],
+    ) -> T:
+        """
+        call for coroutines, sharing the same limits and metrics
+        """
+        for attempt in range(self.retries + 1):
+            await self.requests.acquire_async(1)
+            await self.tokens.acquire_async(estimated_tokens)
+            await self.concurrency.acquire_async()
+            start = time.perf_counter()
+            error = None
+
+            try:
+                result = await fn()
+            except Exception as e: # pylint: disable=broad-exception-caught
+                error = e
+            finally:
+                # Also runs when the task is cancelled mid call, so the slot is never lost
+                self.concurrency.release(self._throttled(error))
+
+            if error is not None:
+                await asyncio.sleep(self._failed(error, attempt, start))
+                continue
+
+            self._succeeded(used_tokens(result), estimated_tokens, start)
+            return result
+
+        raise AssertionError("unreachable")
+
+    def stats(self) -> dict:
+        """
+        Call metrics plus the current concurrency limit
+        """
+        return {**self.metrics.snapshot(), "limit": self.concurrency.limit}
+
+_controller: LLMController | None = None # pylint: disable=invalid-name
+_controller_lock = threading.Lock()
+
+def get_controller(share: float = 1.0) -> LLMController:
+    """
+    Returns the process wide controller, creating it on first use
+    share is this process's fraction of the quota when several workers split it
+    """
+    global _controller # pylint: disable=global-statement
+
+    with _controller_lock:
+        if _controller is None:
+            _controller = LLMController(
+                rpm=const.GEMINI_RPM * share,
+                tpm=const.GEMINI_TPM * share,
+                max_concurrency=max(1, int(const.LLM_MAX_CONCURRENCY * share)),
+            )
+
+    return _controller
@@ -3,27 +3,117 @@ Script for crawling outlines via exposed API Route
 """
 
 import argparse
+import multiprocessing
 import os
-import csv
-import requests
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import chain
+from uuid import uuid4
 from tqdm import tqdm
 from dotenv import load_dotenv
-from uuid import uuid4
-from google import genai 
-import json
 
 from modules import constants as const
-from modules import parse_course
-from modules import models
-
-def main (verbose: bool, query: str) -> bool:
+from modules import fetch
+from modules import extract
+from modules import llm_cache
+from modules import llm_control
+from modules import archive
+from modules import catalog
+from modules import sinks
+from modules import records
+from modules import pipeline
+from modules import manifest
+from modules import journal
+from modules import metrics
+
+def course_rows(course: dict, term: str, description: str, extracted: records.CourseRecords) -> dict[str, list[list]]:
+    """
+    Rows for every output table of one course, keyed by table name
+    Assigns real IDs to extracted in place, fresh ones on every call so courses sharing one extraction never share IDs
+    """
+    course_id = uuid4()
+
+    rows = {
+        "personnels": [],
+        "assessment_groups": [],
+        "assessments": [],
+        "sections": [],
+        "types": [],
+        "outlines": [[course_id, course["courses"], course["title"], description, term, course["url"]]],
+    }
+
+    rows["personnels"] = [[course_id, p.name, p.role, p.email] for p in extracted.personnels]
+
+    if extracted.assessment_groups or extracted.assessments:
+        # Now assign real UUIDs
+        extracted.assign_ids()
+
+        rows["assessment_groups"] = [
+            [g.id, course_id, g.weight, g.count, g.drop, g.name, g.type, g.optional]
+            for g in extracted.assessment_groups
+        ]
+
+        rows["assessments"] = [
+            [a.id, a.group_id, a.weight, a.index, a.due_date, a.name]
+            for a in extracted.assessments
+        ]
+
+    for section in course["sections"].split(","):
+        if "-" in section: #101-106
+            start_range = int(section.split("-")[0])
+            end_range = int((section.split("-")[1]))
+
+            for i in range(start_range, end_range+1):
+                rows["sections"].append([i, course_id])
+        else:
+            rows["sections"].append([section.strip(), course_id])
+
+    for type_ in course["types"]:
+        rows["types"].append([type_, course_id])
+
+    return rows
+
+def main (
+    verbose: bool,
+    query: str,
+    *,
+    per_host: int | None = None,
+    progress: bool = True,
+    use_cache: bool = True,
+    use_rules: bool = True,
+    replay: bool = False,
+    sink: str = "csv",
+    courses: list[dict] | None = None,
+    llm_share: float = 1.0,
+    llm_in_flight: int = const.LLM_IN_FLIGHT,
+    fetch_workers: int | None = None,
+    parse_workers: int = const.PIPELINE_PARSE_WORKERS,
+    queue_size: int = const.PIPELINE_QUEUE_SIZE,
+    delta: bool = False,
+    fresh_since: float | None = None,
+) -> bool:
     """
     Check all .env secrets
-    Make API call
+    Make API call, or read archived responses when replaying
+    The catalog response is decoded as it streams in and filtered lazily, so outline fetches
+    start before the download finishes
+    courses is this department's slice of a prefetched catalog, skipping the API call; without it
+    the department's catalog is streamed
+    llm_share is this process's fraction of the Gemini quota
+    Courses flow through pipeline.Pipeline: fetch_workers threads fetch pages, parse_workers
+    processes parse them, up to llm_in_flight extractions run concurrently, and a single writer
+    commits rows in catalog order. Stages are joined by queues of queue_size
     Request each page, pass response to parse_course
-    Write extracted data to a CSV
+    Write extracted data to the selected sink (CSV, Parquet or SQLite)
+    Every committed course is fingerprinted in the course manifest. With delta, courses already
+    in the sink are revisited and only those whose catalog entry or outline changed are re-extracted
+    Cross-listed courses sharing an outline url are fetched and extracted once, and fresh_since
+    reuses pages other departments already archived during the same sweep (by default pages
+    archived since this department started)
     """
 
+    fresh_since = time.time() if fresh_since is None else fresh_since
+
     #Load and check env secrets
     env_loaded = load_dotenv()
 
@@ -39,13 +129,13 @@ def main (verbose: bool, query: str) -> bool:
 
     cookie = os.getenv("COOKIE")
 
-    if not cookie:
+    if not cookie and not replay:
         tqdm.write(const.err("Could not find COOKIE in .env"))
         return False
 
     session = os.getenv("SESSION_COOKIE")
 
-    if not session:
+    if not session and not replay:
         tqdm.write(const.err("Could not find SESSION_COOKIE in .env"))
         return False
 
@@ -67,6 +157,10 @@ def main (verbose: bool, query: str) -> bool:
         tqdm.write(const.err("Could not find GEMINI_API_KEY in .env"))
         return False
 
+    if delta and sink == "parquet":
+        tqdm.write(const.err("Delta runs need the csv or sqlite sink, parquet parts cannot replace a course"))
+        return False
+
     #Create output folder if not there
     if not os.path.exists(f"{const.SCRAPE_OUTPUT_PATH}/{query}/"):
         os.makedirs(f"{const.SCRAPE_OUTPUT_PATH}/{query}/")
@@ -77,160 +171,177 @@ def main (verbose: bool, query: str) -> bool:
     if verbose:
         tqdm.write("Requesting API data...")
 
-    courses = requests.get(endpoint+query, timeout=60, cookies={"csrftoken": cookie}).json()
+    run_metrics = metrics.get_metrics()
+    fetcher = fetch.get_client(per_host)
+    pages = archive.get_archive()
+    llm = extract.get_client(api_key)
+    controller = llm_control.get_controller(llm_share)
+    cache = llm_cache.get_cache() if use_cache else None
 
-    if not courses:
-        tqdm.write(const.err("No response returned from API"))
-        return False
-    
-    covered_courses = []
+    if courses is None:
+        stream = catalog.stream_courses(endpoint+query, term, cookies={"csrftoken": cookie}, per_host=per_host, replay=replay)
 
-    if os.path.isfile(f'{const.SCRAPE_OUTPUT_PATH}/{query}/outlines.csv'):
+        # Only wait for the first entry, the rest is read as the pipeline takes it
         try:
-            with open(f'{const.SCRAPE_OUTPUT_PATH}/{query}/outlines.csv', "r", encoding="utf-8") as outlines_csv:
-                outlines_reader = csv.reader(outlines_csv)
-                for i, row in enumerate(outlines_reader):
-                    if i != 0:
-                        tqdm.write(str(row[1]))
-                        covered_courses.append(row[1])
-
-        except IOError as e:
-            tqdm.write(const.err(str(e)))
+            first = next(stream, None)
+        except (IOError, ValueError, LookupError) as e:
+            tqdm.write(const.err(f"Catalog request failed: {e}"))
+            return False
+
+        if first is None:
+            tqdm.write(const.err("No response returned from API"))
             return False
 
-    filtered_data = [course for course in courses if course["term"]==term and course["courses"].startswith(f"{query} ") and course["courses"] not in covered_courses]
+        courses = chain([first], stream)
 
     try:
         with (
-            const.open_csv_with_header(f'{const.SCRAPE_OUTPUT_PATH}/{query}/outlines.csv', const.outlines_columns)[0] as outlines_csv,
-            const.open_csv_with_header(f'{const.SCRAPE_OUTPUT_PATH}/{query}/sections.csv', const.sections_columns)[0] as sections_csv,
-            const.open_csv_with_header(f'{const.SCRAPE_OUTPUT_PATH}/{query}/types.csv', const.types_columns)[0] as types_csv,
-            const.open_csv_with_header(f'{const.SCRAPE_OUTPUT_PATH}/{query}/assessment_groups.csv', const.assessment_groups_columns)[0] as assessment_groups_csv,
-            const.open_csv_with_header(f'{const.SCRAPE_OUTPUT_PATH}/{query}/assessments.csv', const.assessments_columns)[0] as assessments_csv,
-            const.open_csv_with_header(f'{const.SCRAPE_OUTPUT_PATH}/{query}/personnels.csv', const.personnels_columns)[0] as personnels_csv,
+            sinks.open_course_sink(sink, query, term) as course_sink,
+            extract.AsyncExtractor(llm, controller, cache=cache, use_rules=use_rules, in_flight=llm_in_flight) as extractor,
         ):
-            outlines_writer = csv.writer(outlines_csv, lineterminator="\n")
-            sections_writer = csv.writer(sections_csv, lineterminator="\n")
-            types_writer = csv.writer(types_csv, lineterminator="\n")
-            assessment_groups_writer = csv.writer(assessment_groups_csv, lineterminator="\n")
-            assessments_writer = csv.writer(assessments_csv, lineterminator="\n")
-            personnels_writer = csv.writer(personnels_csv, lineterminator="\n")
-
-            for i, course in tqdm(enumerate(filtered_data), total=len(filtered_data)):
-                course_id = uuid4()
-                code = course["courses"]
-                name = course["title"]
-                url = course["url"]
-                types = course["types"]
-                sections = course["sections"].split(",")
-
-                tqdm.write(f"Parsing {code}...")
-
-                if not url:
-                    tqdm.write(const.warning(f"No outline url provided for {code}"))
-                else:
-                    course_page = requests.get(base_url+url, timeout=60, cookies={"csrftoken": cookie, "sessionid": session})
-
-                    tqdm.write(f"Page Status: {course_page.status_code}")
-
-                    if course_page.status_code==404:
-                        tqdm.write(const.warning(f"Page not found. 404 Error. {url}"))
-                        return False
-
-                    res, data = parse_course.main(course_page.text)
-
-                    if not res:
-                        return False
-
-                    personnels_html = str(data["personnels"])
-
-                    if personnels_html:
-                        client = genai.Client(api_key=api_key)
-
-                        response = client.models.generate_content(
-                            model="gemini-2.5-flash",
-                            contents=const.personnels_prompt(personnels_html),
-                            config={
-                                "response_mime_type": "application/json",
-                                "response_schema": models.ParsedPersonnelsOutput,
-                            }
-                        )
-                        
-                        for person in response.parsed.personnels:
-                            p = person.model_dump()
-                            personnels_writer.writerow([
-                                course_id,
-                                p["name"],
-                                p["role"],
-                                p["email"]
-                            ])
-                    
-                    table_html = str(data["assessments_table"])
-                    
-                    if table_html:
-                        client = genai.Client(api_key=api_key)
-
-                        response = client.models.generate_content(
-                            model="gemini-2.5-flash",
-                            contents=const.prompt(table_html),
-                            config={
-                                "response_mime_type": "application/json",
-                                "response_schema": models.ParsedAssessmentOutput,
-                            }
-                        )
-
-                        # Now assign real UUIDs
-                        parsed = const.assign_ids(response.parsed)
-
-                        tqdm.write(f"RES {str(parsed.model_dump_json(indent=2))}")
-
-                        # Write assessment groups
-                        for group in parsed.assessment_groups:
-                            g = group.model_dump()
-                            assessment_groups_writer.writerow([
-                                g["id"],
-                                course_id,
-                                g["weight"],
-                                g["count"],
-                                g["drop"],
-                                g["name"],
-                                g.get("type"),     # might be None if not present
-                                g.get("optional", False),
-                            ])
-
-                        # Write assessments
-                        for assessment in parsed.assessments:
-                            a = assessment.model_dump()
-                            assessments_writer.writerow([
-                                a["id"],
-                                a["group_id"],
-                                a["weight"],
-                                a["index"],
-                                a["due_date"],
-                                a["name"],
-                            ])
-
-                    outlines_writer.writerow([course_id, code, name, data["description"], term, url])
-
-                    for section in sections:
-                        if "-" in section: #101-106
-                            start_range = int(section.split("-")[0])
-                            end_range = int((section.split("-")[1]))
-
-                            for i in range(start_range, end_range+1):
-                                sections_writer.writerow([i, course_id])
-                        else:
-                            sections_writer.writerow([section.strip(), course_id])
-
-                    for type_ in types:
-                        types_writer.writerow([type_, course_id])
-
-
-    except IOError as e:
+            covered_courses = course_sink.completed_codes()
+            changes = manifest.Delta(manifest.get_manifest(), query, term, covered_courses, delta)
+
+            filtered_data = (course for course in courses if course["term"]==term and course["courses"].startswith(f"{query} ") and (delta or course["courses"] not in covered_courses))
+
+            def fetch_page(course: dict, conditional: bool) -> tuple[int, str, dict[str, str]]:
+                return fetch.fetch_page(
+                    fetcher,
+                    pages,
+                    fetch.normalize_url(base_url+course["url"]),
+                    term,
+                    cookies={"csrftoken": cookie, "sessionid": session},
+                    replay=replay,
+                    validators=changes.validators(course) if conditional else None,
+                    fresh_since=fresh_since,
+                )
+
+            def commit(course: dict, description: str, extracted: records.CourseRecords):
+                with run_metrics.span("write", sink=sink):
+                    course_sink.commit(course_rows(course, term, description, extracted))
+                changes.committed(course)
+
+            stages = pipeline.Pipeline(
+                fetch_page,
+                extractor,
+                commit,
+                fetch_workers=fetch_workers or per_host or const.FETCH_PER_HOST,
+                parse_workers=parse_workers,
+                queue_size=queue_size,
+                delta=changes,
+            )
+
+            completed = stages.run(filtered_data, progress)
+
+            for name, stats in stages.stats().items():
+                run_metrics.count("pipeline_blocked_seconds", stats["put_wait"], queue=name, side="producer")
+                run_metrics.count("pipeline_blocked_seconds", stats["get_wait"], queue=name, side="consumer")
+
+            for kind, count in stages.shared.items():
+                run_metrics.count("shared", count, kind=kind)
+
+            if verbose:
+                tqdm.write(f"Pipeline queues for {query}:\n{pipeline.format_stats(stages.stats())}")
+                tqdm.write(f"Shared with an earlier course: {stages.shared}")
+
+        # Changed courses were appended after their old rows
+        if delta and sink == "csv" and changes.counts["changed"]:
+            dropped = journal.compact(f"{const.SCRAPE_OUTPUT_PATH}{query}")
+
+            if verbose:
+                tqdm.write(f"Dropped {dropped} superseded rows from {query}")
+
+    except (IOError, ValueError, ImportError) as e:
         tqdm.write(const.err(str(e)))
         return False
 
-    return True
+    for outcome, count in changes.counts.items():
+        run_metrics.count("courses", count, outcome=outcome)
+
+    if verbose:
+        tqdm.write(f"Courses for {query}: {changes.summary()}")
+
+    if cache is not None and verbose:
+        tqdm.write(f"LLM cache: {cache.stats()}")
+
+    if verbose:
+        tqdm.write(f"LLM calls: {controller.stats()}")
+
+    return completed
+
+def run_department(verbose: bool, dept: str, progress: bool, profile: bool = False, **options) -> tuple[str, bool, float, str, dict | None]:
+    """
+    Run main for a single department, never letting one failure escape to the caller
+    options are forwarded to main as keyword arguments
+    In a worker process the department's metrics are returned for the parent to merge
+    """
+    worker = multiprocessing.parent_process() is not None
+    run_metrics = metrics.get_metrics()
+
+    if worker:
+        # A forked worker starts with a copy of whatever the parent had recorded
+        run_metrics.enabled = profile
+        run_metrics.reset()
+
+    start = time.perf_counter()
+
+    try:
+        result_main = main(verbose, dept, progress=progress, **options)
+        error = ""
+    except Exception as e: # pylint: disable=broad-exception-caught
+        result_main = False
+        error = f"{type(e).__name__}: {e}"
+
+    return dept, result_main, time.perf_counter() - start, error, run_metrics.drain() if worker else None
+
+def run_departments(verbose: bool, departments: list[str], workers: int, index: catalog.CatalogIndex | None = None, **options) -> bool:
+    """
+    Scrape departments sequentially or sharded across a process pool
+    Each department gets its slice of index when one is given and covers it
+    Print a per department summary once everything has finished
+    Metrics of worker processes are merged into this process's
+    """
+    results = []
+
+    # Worker processes each get an equal share of the Gemini quota, and pages archived since the
+    # sweep started are not fetched again by a later department
+    options = {**options, "llm_share": 1 / max(1, workers), "fresh_since": time.time()}
+
+    def dept_options(dept: str) -> dict:
+        # A department the catalog could not cover requests its own, as a department run on its own does
+        return options if index is None or not index.covers(dept) else {**options, "courses": index.slice(dept)}
+
+    if workers <= 1:
+        for dept in departments:
+            results.append(run_department(verbose, dept, True, **dept_options(dept)))
+            tqdm.write(f"Process {'completed successfully' if results[-1][1] else 'failed'} for {dept}.")
+    else:
+        # A SQLite connection or pooled socket must never be used on both sides of a fork
+        fetch.close_client()
+        archive.close_archive()
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            profile = metrics.get_metrics().enabled
+            futures = [pool.submit(run_department, verbose, dept, False, profile, **dept_options(dept)) for dept in departments]
+
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Departments", unit="dept"):
+                results.append(future.result())
+                dept, result_main, _, error, snapshot = results[-1]
+
+                if snapshot is not None:
+                    metrics.get_metrics().merge(snapshot)
+
+                tqdm.write(f"Process {'completed successfully' if result_main else 'failed'} for {dept}. {error}".strip())
+
+    failed = [dept for dept, result_main, _, _, _ in results if not result_main]
+
+    tqdm.write("\nSummary:")
+    for dept, result_main, elapsed, error, _ in sorted(results, key=lambda result: result[0]):
+        status = const.success("ok") if result_main else const.err(error or "failed")
+        tqdm.write(f"  {dept:<8}{elapsed:>9.1f}s  {status}")
+    tqdm.write(f"{len(results) - len(failed)}/{len(results)} departments succeeded.")
+
+    return not failed
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -244,10 +355,125 @@ if __name__ == "__main__":
         help="Make output more verbose with logging"
     )
 
+    _ = parser.add_argument(
+        "--per-host",
+        type=int,
+        default=const.FETCH_PER_HOST,
+        help="Maximum concurrent connections per host"
+    )
+
+    _ = parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes to shard departments across"
+    )
+
+    _ = parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always call Gemini instead of reusing cached extraction results"
+    )
+
+    _ = parser.add_argument(
+        "--no-rules",
+        action="store_true",
+        help="Send every section to Gemini instead of parsing well-formed ones locally"
+    )
+
+    _ = parser.add_argument(
+        "--sink",
+        choices=const.SCRAPE_SINKS,
+        default="csv",
+        help="Output format for the scraped tables, sqlite writes straight to one database and needs no aggregation"
+    )
+
+    _ = parser.add_argument(
+        "--llm-in-flight",
+        type=int,
+        default=const.LLM_IN_FLIGHT,
+        help="Course extractions to run concurrently per worker"
+    )
+
+    _ = parser.add_argument(
+        "--fetch-workers",
+        type=int,
+        default=None,
+        help="Threads fetching outline pages per worker, defaults to --per-host"
+    )
+
+    _ = parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=const.PIPELINE_PARSE_WORKERS,
+        help="Processes parsing outline HTML per worker, 0 parses on the pipeline thread"
+    )
+
+    _ = parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=const.PIPELINE_QUEUE_SIZE,
+        help="Capacity of each queue between pipeline stages"
+    )
+
+    _ = parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Recheck courses that were already scraped and re-extract only those whose catalog entry or outline changed"
+    )
+
+    _ = parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=f"Record stage timings, token and HTTP counters and write a JSON report and Prometheus textfile to {const.METRICS_PATH}"
+    )
+
+    _ = parser.add_argument(
+        "--stream-catalog",
+        action="store_true",
+        help="Stream each department's catalog as its scrape runs instead of indexing the whole catalog up front, outline fetches start before it has downloaded. Without it the whole catalog is held in memory for the run, so peak memory grows with the catalog size; this keeps it flat at the cost of one catalog request per department"
+    )
+
+    _ = parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="Run the pipeline from archived pages without touching the network"
+    )
+
     args: argparse.Namespace = parser.parse_args()
-    
-    for dept in const.DEPARTMENTS:
-        if main(args.verbose, dept):
-            tqdm.write(f"Process completed successfully for {dept}.")
-        else:
-            tqdm.write(f"Process failed for {dept}.")
+
+    metrics.get_metrics().enabled = args.profile
+
+    catalog_index = None
+
+    # Indexed by default, one catalog request for every department but the whole catalog stays in memory
+    # Streaming, each department requests its own slice and feeds the pipeline as it arrives
+    if not args.stream_catalog:
+        catalog_loaded, catalog_index = catalog.main(args.verbose, const.DEPARTMENTS, per_host=args.per_host, replay=args.replay)
+
+        if not catalog_loaded:
+            raise SystemExit(1)
+
+        tqdm.write(f"{catalog_index.count(const.DEPARTMENTS)} catalog courses for term {catalog_index.term} across {len(const.DEPARTMENTS)} departments.")
+
+    run_departments(
+        args.verbose,
+        const.DEPARTMENTS,
+        args.workers,
+        catalog_index,
+        per_host=args.per_host,
+        use_cache=not args.no_cache,
+        use_rules=not args.no_rules,
+        replay=args.replay,
+        sink=args.sink,
+        llm_in_flight=args.llm_in_flight,
+        fetch_workers=args.fetch_workers,
+        parse_workers=args.parse_workers,
+        queue_size=args.queue_size,
+        delta=args.delta,
+    )
+
+    if args.profile:
+        report_path, textfile_path = metrics.get_metrics().export()
+        tqdm.write(f"Run report written to {report_path}, Prometheus metrics to {textfile_path}")
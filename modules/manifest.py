@@ -0,0 +1,226 @@
+"""
+Per course record of what each scraped outline was built from, for delta runs
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from modules import constants as const
+
+def catalog_hash(course: dict) -> str:
+    """
+    Hash of a course's catalog entry, any field changing changes the hash
+    """
+    return text_hash(json.dumps(course, sort_keys=True, ensure_ascii=False, default=str))
+
+def text_hash(text: str) -> str:
+    """
+    sha256 of some text
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class CourseManifest:
+    """
+    SQLite table of the catalog entry, page and outline content hashes every stored course was scraped from
+    content_hash covers only the sections fed to extraction, so pages that differ in markup
+    noise (tokens, timestamps) still match. etag and last_modified allow conditional requests.
+    """
+
+    COLUMNS = ("url", "catalog_hash", "page_hash", "content_hash", "etag", "last_modified")
+
+    def __init__(self, path: str = const.COURSE_MANIFEST_PATH):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS courses (
+                code TEXT NOT NULL,
+                term TEXT NOT NULL,
+                url TEXT,
+                catalog_hash TEXT NOT NULL,
+                page_hash TEXT,
+                content_hash TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                checked_at REAL NOT NULL,
+                changed_at REAL NOT NULL,
+                PRIMARY KEY (code, term)
+            )
+            """
+        )
+        self._conn.commit()
+
+    def entries(self, term: str, dept: str) -> dict[str, dict]:
+        """
+        Entries of one department's courses for term, keyed by code
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT code, {', '.join(self.COLUMNS)} FROM courses WHERE term = ? AND code >= ? AND code < ?",
+                (term, f"{dept} ", f"{dept}!"),
+            ).fetchall()
+
+        return {row[0]: dict(zip(self.COLUMNS, row[1:])) for row in rows}
+
+    def put(self, code: str, term: str, entry: dict, changed: bool):
+        """
+        Store what a course was last checked against
+        changed_at only moves when the stored outline was rewritten
+        """
+        now = time.time()
+        values = [entry.get(column) for column in self.COLUMNS]
+
+        with self._lock:
+            self._conn.execute(
+                f"""
+                INSERT INTO courses (code, term, {', '.join(self.COLUMNS)}, checked_at, changed_at)
+                VALUES (?, ?, {', '.join('?' * len(self.COLUMNS))}, ?, ?)
+                ON CONFLICT (code, term) DO UPDATE SET
+                    {', '.join(f'{column} = excluded.{column}' for column in self.COLUMNS)},
+                    checked_at = excluded.checked_at,
+                    changed_at = CASE WHEN ? THEN excluded.changed_at ELSE courses.changed_at END
+                """,
+                [code, term, *values, now, now, changed],
+            )
+            self._conn.commit()
+
+    def close(self):
+        """
+        Close the underlying connection
+        """
+        with self._lock:
+            self._conn.close()
+
+class Delta: # pylint: disable=too-many-instance-attributes
+    """
+    One department's change detection during a scrape
+    Fingerprints are gathered as a course moves through the pipeline and written to the
+    manifest once the course is committed or carried forward. When enabled, a course already
+    in the sink whose catalog entry is unchanged is skipped as soon as its page hash (or a
+    304) or its outline content hash matches the manifest. Disabled, it only records, so the
+    next delta run has something to compare against.
+    """
+
+    def __init__(self, store: CourseManifest, dept: str, term: str, covered: set[str], enabled: bool):
+        self.store = store
+        self.term = term
+        self.covered = covered
+        self.enabled = enabled
+        self.previous = store.entries(term, dept)
+        self.counts = {"new": 0, "changed": 0, "unchanged": 0}
+
+        self._pending: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def _candidate(self, course: dict) -> dict | None:
+        """
+        Previous entry of a stored course whose catalog entry has not changed, None otherwise
+        """
+        if not self.enabled or course["courses"] not in self.covered:
+            return None
+
+        previous = self.previous.get(course["courses"])
+
+        if previous is None or previous["catalog_hash"] != catalog_hash(course):
+            return None
+
+        return previous
+
+    def _update(self, course: dict, **fields):
+        with self._lock:
+            pending = self._pending.setdefault(
+                course["courses"], {"url": course["url"], "catalog_hash": catalog_hash(course)}
+            )
+            pending.update(fields)
+
+    def validators(self, course: dict) -> dict[str, str]:
+        """
+        Conditional request validators for a course's page, empty unless a 304 could let it be skipped
+        """
+        previous = self._candidate(course)
+
+        if previous is None or previous["url"] != course["url"]:
+            return {}
+
+        return {key: previous[key] for key in ("etag", "last_modified") if previous[key]}
+
+    def page_unchanged(self, course: dict, status: int, page_text: str, validators: dict[str, str]) -> bool:
+        """
+        Record a fetched page, True if the course can be carried forward without parsing it
+        """
+        previous = self._candidate(course)
+
+        if status == 304 and previous is not None:
+            self._carry(course, previous)
+            return True
+
+        page_hash = text_hash(page_text)
+        self._update(course, page_hash=page_hash, etag=validators.get("etag"), last_modified=validators.get("last_modified"))
+
+        if previous is not None and previous["page_hash"] == page_hash:
+            self._carry(course, previous)
+            return True
+
+        return False
+
+    def content_unchanged(self, course: dict, sections: tuple[str, ...]) -> bool:
+        """
+        Record a parsed outline, True if the course can be carried forward without extracting it
+        """
+        content_hash = text_hash(json.dumps(sections, ensure_ascii=False))
+        self._update(course, content_hash=content_hash)
+
+        previous = self._candidate(course)
+
+        if previous is not None and previous["content_hash"] == content_hash:
+            self._carry(course, previous)
+            return True
+
+        return False
+
+    def _carry(self, course: dict, previous: dict):
+        with self._lock:
+            entry = {**previous, **self._pending.pop(course["courses"], {})}
+            self.counts["unchanged"] += 1
+
+        self.store.put(course["courses"], self.term, entry, changed=False)
+
+    def committed(self, course: dict):
+        """
+        Record a course whose rows were just written
+        """
+        with self._lock:
+            entry = self._pending.pop(course["courses"], {"url": course["url"], "catalog_hash": catalog_hash(course)})
+            self.counts["changed" if course["courses"] in self.covered else "new"] += 1
+
+        self.store.put(course["courses"], self.term, entry, changed=True)
+
+    def summary(self) -> str:
+        """
+        Human readable course counts by outcome
+        """
+        return ", ".join(f"{count} {outcome}" for outcome, count in self.counts.items())
+
+_manifest: CourseManifest | None = None # pylint: disable=invalid-name
+_manifest_lock = threading.Lock()
+
+def get_manifest() -> CourseManifest:
+    """
+    Returns the process wide CourseManifest, opening it on first use
+    """
+    global _manifest # pylint: disable=global-statement
+
+    with _manifest_lock:
+        if _manifest is None:
+            _manifest = CourseManifest()
+
+    return _manifest
@@ -0,0 +1,234 @@
+"""
+Run metrics: stage spans, token, status and byte counters, exported as a JSON report and a Prometheus textfile
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from modules import constants as const
+
+def _key(name: str, labels: dict[str, str]) -> tuple:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+def _labels_text(labels: dict[str, str]) -> str:
+    """
+    Prometheus label set, escaped
+    """
+    if not labels:
+        return ""
+
+    escaped = (
+        (label, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for label, value in labels.items()
+    )
+    return "{" + ",".join(f'{label}="{value}"' for label, value in escaped) + "}"
+
+class Metrics:
+    """
+    Thread safe counters and span histograms keyed by name and labels
+    Disabled (the default) every call returns immediately, so instrumented code pays
+    next to nothing unless a run is profiled. Snapshots are plain dicts, so worker
+    processes can hand theirs back to be merged.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = const.METRICS_BUCKETS):
+        self.enabled = False
+        self.buckets = buckets
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._counters: dict[tuple, float] = {}
+        self._spans: dict[tuple, dict] = {}
+
+    def count(self, name: str, value: float = 1, **labels):
+        """
+        Add value to a counter
+        """
+        if not self.enabled:
+            return
+
+        key = _key(name, labels)
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """
+        Record one span of a stage that was timed elsewhere
+        """
+        if not self.enabled:
+            return
+
+        key = _key(name, labels)
+
+        with self._lock:
+            span = self._spans.setdefault(key, {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(self.buckets)})
+            span["count"] += 1
+            span["sum"] += seconds
+            span["max"] = max(span["max"], seconds)
+
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    span["buckets"][i] += 1
+                    break
+
+    def span(self, name: str, **labels):
+        """
+        Context manager timing one span of a stage
+        """
+        if not self.enabled:
+            return nullcontext()
+
+        return self._timed(name, labels)
+
+    @contextmanager
+    def _timed(self, name: str, labels: dict[str, str]):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _snapshot(self) -> dict:
+        return {
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ],
+            "spans": [
+                {"name": name, "labels": dict(labels), **span, "buckets": list(span["buckets"])}
+                for (name, labels), span in sorted(self._spans.items())
+            ],
+        }
+
+    def snapshot(self) -> dict:
+        """
+        Every counter and span as plain data
+        """
+        with self._lock:
+            return self._snapshot()
+
+    def reset(self):
+        """
+        Drop everything recorded so far
+        """
+        with self._lock:
+            self._counters.clear()
+            self._spans.clear()
+
+    def drain(self) -> dict:
+        """
+        Snapshot and reset in one step
+        """
+        with self._lock:
+            snapshot = self._snapshot()
+            self._counters.clear()
+            self._spans.clear()
+
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        """
+        Add another process's snapshot into this one
+        """
+        with self._lock:
+            for counter in snapshot["counters"]:
+                key = _key(counter["name"], counter["labels"])
+                self._counters[key] = self._counters.get(key, 0) + counter["value"]
+
+            for other in snapshot["spans"]:
+                key = _key(other["name"], other["labels"])
+                span = self._spans.setdefault(key, {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(self.buckets)})
+                span["count"] += other["count"]
+                span["sum"] += other["sum"]
+                span["max"] = max(span["max"], other["max"])
+                span["buckets"] = [mine + theirs for mine, theirs in zip(span["buckets"], other["buckets"])]
+
+    def report(self) -> dict:
+        """
+        JSON run report: time per stage with its share of all span time, then the raw counters and spans
+        """
+        snapshot = self.snapshot()
+        totals: dict[str, dict] = {}
+
+        for span in snapshot["spans"]:
+            total = totals.setdefault(span["name"], {"count": 0, "seconds": 0.0, "max": 0.0})
+            total["count"] += span["count"]
+            total["seconds"] += span["sum"]
+            total["max"] = max(total["max"], span["max"])
+
+        all_seconds = sum(total["seconds"] for total in totals.values())
+
+        for total in totals.values():
+            total["mean"] = total["seconds"] / total["count"] if total["count"] else 0.0
+            total["share"] = total["seconds"] / all_seconds if all_seconds else 0.0
+
+        return {
+            "started": self.started,
+            "finished": time.time(),
+            "elapsed": time.time() - self.started,
+            "stages": dict(sorted(totals.items(), key=lambda item: -item[1]["seconds"])),
+            **snapshot,
+        }
+
+    def prometheus(self) -> str:
+        """
+        Prometheus text exposition of every counter and span histogram
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        for name in sorted({counter["name"] for counter in snapshot["counters"]}):
+            metric = f"{const.METRICS_PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+
+            for counter in snapshot["counters"]:
+                if counter["name"] == name:
+                    lines.append(f"{metric}{_labels_text(counter['labels'])} {counter['value']:g}")
+
+        metric = f"{const.METRICS_PREFIX}_span_seconds"
+        lines.append(f"# HELP {metric} Time spent in each stage of the run")
+        lines.append(f"# TYPE {metric} histogram")
+
+        for span in snapshot["spans"]:
+            labels = {"span": span["name"], **span["labels"]}
+            cumulative = 0
+
+            for bound, bucket in zip(self.buckets, span["buckets"]):
+                cumulative += bucket
+                lines.append(f"{metric}_bucket{_labels_text({**labels, 'le': f'{bound:g}'})} {cumulative}")
+
+            lines.append(f"{metric}_bucket{_labels_text({**labels, 'le': '+Inf'})} {span['count']}")
+            lines.append(f"{metric}_sum{_labels_text(labels)} {span['sum']:.6f}")
+            lines.append(f"{metric}_count{_labels_text(labels)} {span['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, directory: str = const.METRICS_PATH) -> tuple[str, str]:
+        """
+        Write the JSON report for this run and replace the Prometheus textfile
+        Returns both paths
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        report_path = os.path.join(directory, f"run-{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))}.json")
+        with open(report_path, "w", encoding="utf-8") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+        # Textfile collectors may read at any moment, so never expose a partial file
+        textfile_path = os.path.join(directory, const.METRICS_TEXTFILE)
+        with open(textfile_path + ".tmp", "w", encoding="utf-8") as textfile:
+            textfile.write(self.prometheus())
+        os.replace(textfile_path + ".tmp", textfile_path)
+
+        return report_path, textfile_path
+
+_metrics = Metrics()
+
+def get_metrics() -> Metrics:
+    """
+    Returns the process wide Metrics
+    """
+    return _metrics
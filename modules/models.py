@@ -1,6 +1,14 @@
+"""
+Structured output schemas for the Gemini parsing calls
+"""
+
 from pydantic import BaseModel, Field
 
 class AssessmentGroups(BaseModel):
+    """
+    One weighted group of assessments, ids are placeholders until assigned
+    """
+
     id: str = Field(..., description="Placeholder ID like G1, G2, etc.")
     course_id: str | None = Field()
     weight: float = Field(...)
@@ -10,22 +18,47 @@ class AssessmentGroups(BaseModel):
     optional: bool = Field(...)
 
 class Assessments(BaseModel):
+    """
+    One assessment item within a group
+    """
+
     id: str | None = None
     group_id: str = Field(...)
     weight: float = Field(...)
     index: int = Field(...)
-    due_date: str | None = Field() 
+    due_date: str | None = Field()
     name: str = Field(...)
 
 class ParsedAssessmentOutput(BaseModel):
+    """
+    Response schema for the assessment prompt
+    """
+
     assessment_groups: list[AssessmentGroups]
     assessments: list[Assessments]
 
 class Personnels(BaseModel):
+    """
+    One member of a course's instructional team
+    """
+
     course_id: str | None = None
     name: str = Field(...)
     role: str = Field(...)
     email: str | None = Field()
 
 class ParsedPersonnelsOutput(BaseModel):
+    """
+    Response schema for the personnel prompt
+    """
+
     personnels: list[Personnels]
+
+class ParsedCourseOutput(BaseModel):
+    """
+    Response schema for the combined personnel and assessment prompt
+    """
+
+    personnels: list[Personnels]
+    assessment_groups: list[AssessmentGroups]
+    assessments: list[Assessments]
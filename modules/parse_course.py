@@ -2,48 +2,124 @@
 Standalone script for parsing outline
 """
 
-from bs4 import BeautifulSoup, Tag
+import argparse
+import glob
+import os
 import re
+import time
 
-def extract_assessment_section_html(course_content):
-    # find h2/h3 that mentions "assessment"
-    header = course_content.find(
-        lambda t: t.name in ("h2","h3")
-        and re.search(r"assessment|évaluation", t.get_text(" ", strip=True), re.I)
-    )
-    if not header:
+from bs4 import BeautifulSoup, Tag
+from lxml import etree
+from tqdm import tqdm
+
+from modules import constants as const
+from modules import archive
+
+ASSESSMENT_HEADER = re.compile(r"assessment|évaluation", re.I)
+PERSONNEL_HEADER = re.compile(r"(instructional|instructor|ta|team)", re.I)
+SECTION_END_TAGS = frozenset(("h1", "h2", "h3"))
+
+def _has_class(name: str) -> str:
+    """
+    XPath predicate matching one entry of a space separated class attribute
+    """
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+# Precompiled lookups equivalent to the BeautifulSoup .find() chains below
+OUTLINE_CONTENT = etree.XPath(
+    f"/html/body/descendant::*[{_has_class('outline-body')}][1]"
+    f"/descendant::*[{_has_class('outline-content')}][1]"
+)
+SECTION_HEADERS = etree.XPath("descendant::*[self::h2 or self::h3]")
+DESCRIPTION = etree.XPath(
+    "descendant::*[contains(@id, 'course_description') or contains(@id, 'apercu_du_cours')][1]"
+    "/following-sibling::*[1]"
+    f"/descendant::*[{_has_class('course-descriptions')}][1]"
+    f"/descendant::*[{_has_class('description')}][1]"
+    f"/descendant::*[{_has_class('cd-content')}][1]"
+)
+
+def _text(element) -> str:
+    """
+    Same as BeautifulSoup get_text(" ", strip=True)
+    """
+    return " ".join(s.strip() for s in element.itertext() if s.strip())
+
+def _section_html(course_content, pattern: re.Pattern) -> str:
+    """
+    Raw HTML of the siblings following the first h2/h3 matching pattern, up to the next h1/h2/h3
+    """
+    for header in SECTION_HEADERS(course_content):
+        if pattern.search(_text(header)):
+            break
+    else:
         return ""
 
-    # collect siblings until next h1/h2/h3
     parts = []
-    for sib in header.next_siblings:
-        if isinstance(sib, Tag):
-            if sib.name in ("h1","h2","h3"):
-                break
-            parts.append(str(sib))  # keep raw HTML for Gemini
+    for sib in header.itersiblings():
+        if not isinstance(sib.tag, str): # comments and processing instructions
+            continue
+        if sib.tag in SECTION_END_TAGS:
+            break
+        parts.append(etree.tostring(sib, encoding="unicode", method="html", with_tail=False))
     return "".join(parts)
 
-def extract_personnel_section_html(course_content):
-    # find h2/h3 that mentions Instructional, Instructor, TA, or Team
+def extract_assessment_section_html(course_content) -> str:
+    """
+    HTML of the section under the assessment/évaluation heading
+    """
+    return _section_html(course_content, ASSESSMENT_HEADER)
+
+def extract_personnel_section_html(course_content) -> str:
+    """
+    HTML of the section under the instructor/TA/team heading
+    """
+    return _section_html(course_content, PERSONNEL_HEADER)
+
+def main (content: str) -> tuple[bool, dict[str, str]]:
+    """
+    Parse / extract data from HTML
+    """
+
+    root = etree.HTML(content) if content else None
+
+    course_data = {}
+
+    if root is not None:
+        matches = OUTLINE_CONTENT(root)
+
+        if matches:
+            course_content = matches[0]
+
+            desc = DESCRIPTION(course_content)
+
+            course_data["description"] = desc[0].xpath("string()") if desc else ""
+
+            course_data["personnels"] = extract_personnel_section_html(course_content)
+
+            course_data["assessments_table"] = extract_assessment_section_html(course_content)#assessments
+
+    return True, course_data
+
+def _soup_section_html(course_content, pattern: re.Pattern) -> str:
     header = course_content.find(
-        lambda t: t.name in ("h2", "h3")
-        and re.search(r"(instructional|instructor|ta|team)", t.get_text(" ", strip=True), re.I)
+        lambda t: t.name in ("h2","h3")
+        and pattern.search(t.get_text(" ", strip=True))
     )
     if not header:
         return ""
 
-    # collect siblings until next h1/h2/h3
     parts = []
     for sib in header.next_siblings:
         if isinstance(sib, Tag):
-            if sib.name in ("h1", "h2", "h3"):
+            if sib.name in ("h1","h2","h3"):
                 break
-            parts.append(str(sib))  # raw HTML for Gemini
+            parts.append(str(sib))
     return "".join(parts)
 
-def main (content: str) -> tuple[bool, dict[str, str]]:
+def main_soup (content: str) -> tuple[bool, dict[str, str]]:
     """
-    Parse / extract data from HTML
+    Reference BeautifulSoup implementation of main, kept for benchmarking
     """
 
     soup = BeautifulSoup(content, features="lxml")
@@ -69,8 +145,95 @@ def main (content: str) -> tuple[bool, dict[str, str]]:
 
                 course_data["description"] = desc
 
-                course_data["personnels"] = extract_personnel_section_html(course_content)
+                course_data["personnels"] = _soup_section_html(course_content, PERSONNEL_HEADER)
 
-                course_data["assessments_table"] = extract_assessment_section_html(course_content)#assessments
+                course_data["assessments_table"] = _soup_section_html(course_content, ASSESSMENT_HEADER)
 
     return True, course_data
+
+def load_corpus(source: str | None, limit: int) -> list[str]:
+    """
+    Saved outlines from a directory of .html files, or from the page archive by default
+    """
+    if source and os.path.isdir(source):
+        corpus = []
+        for path in sorted(glob.glob(os.path.join(source, "*.html")))[:limit]:
+            with open(path, "r", encoding="utf-8") as html_file:
+                corpus.append(html_file.read())
+        return corpus
+
+    return [
+        text for text in archive.PageArchive(source or const.ARCHIVE_PATH).iter_texts(limit)
+        if "outline-body" in text
+    ]
+
+def benchmark(corpus: list[str], rounds: int) -> bool:
+    """
+    Compare pages/sec of main against main_soup and check both extract the same data
+    """
+    def _normalise(section_html: str) -> str:
+        return _text(etree.HTML(section_html)) if section_html else ""
+
+    mismatches = 0
+
+    for content in corpus:
+        fast, reference = main(content)[1], main_soup(content)[1]
+
+        if fast.get("description") != reference.get("description") or any(
+            _normalise(fast.get(key, "")) != _normalise(reference.get(key, ""))
+            for key in ("personnels", "assessments_table")
+        ):
+            mismatches += 1
+
+    for name, parse in (("lxml", main), ("bs4", main_soup)):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for content in corpus:
+                parse(content)
+        elapsed = time.perf_counter() - start
+        tqdm.write(f"{name:>5}: {rounds * len(corpus) / elapsed:10.1f} pages/sec")
+
+    if mismatches:
+        tqdm.write(const.warning(f"{mismatches}/{len(corpus)} pages extracted differently"))
+    else:
+        tqdm.write(const.success(f"All {len(corpus)} pages extracted identically"))
+
+    return mismatches == 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark outline parsing over a corpus of saved outlines"
+    )
+
+    _ = parser.add_argument(
+        "source",
+        nargs="?",
+        help="Directory of saved .html outlines or a page archive (defaults to the scrape archive)"
+    )
+
+    _ = parser.add_argument(
+        "-n",
+        "--limit",
+        type=int,
+        default=500,
+        help="Maximum number of outlines to load"
+    )
+
+    _ = parser.add_argument(
+        "-r",
+        "--rounds",
+        type=int,
+        default=3,
+        help="Number of passes over the corpus per implementation"
+    )
+
+    args: argparse.Namespace = parser.parse_args()
+
+    outlines = load_corpus(args.source, args.limit)
+
+    if not outlines:
+        tqdm.write(const.err("No outlines found to benchmark"))
+    elif benchmark(outlines, args.rounds):
+        tqdm.write("Process completed successfully.")
+    else:
+        tqdm.write("Process failed.")
@@ -0,0 +1,160 @@
+"""
+Rule based extractor for outline personnel sections
+Handles the usual layout of role headings followed by names and mailto: links.
+"""
+
+import re
+
+from lxml import etree
+
+from modules import constants as const
+from modules import records
+
+PROFESSOR = re.compile(r"\b(?:instructors?|professors?|lecturers?|course coordinators?)\b", re.I)
+TA = re.compile(r"\b(?:[Tt]eaching [Aa]ssistants?|TAs?)\b")
+# Capitalised labels that end a name, e.g. "Office" in "Jane Smith Office DC 2100"
+NAME_STOP = (
+    r"(?!(?i:office|hours?|e-?mail|phone|tel|ext|room|location|website|contact|send|name|role"
+    r"|monday|tuesday|wednesday|thursday|friday|saturday|sunday)\b)"
+)
+NAME = re.compile(rf"(?:Dr\.?\s+|Prof\.?\s+)?({NAME_STOP}[A-Z][\w'’.\-]+(?:\s+{NAME_STOP}[A-Z][\w'’.\-]+){{1,3}})")
+PERSON = re.compile(r"^[A-Z][A-Za-z'’.\-]*(?:\s+[A-Z][A-Za-z'’.\-]*){1,3}$")
+# Link text that names the action rather than the person, e.g. "Send Email" or "Email Jane"
+GENERIC_LINK = re.compile(r"^(?:send\s+(?:an?\s+)?)?(?:e-?mail|contact|message|mail)\b", re.I)
+EMAIL = re.compile(r"[\w.+\-]+@[\w\-]+(?:\.[\w\-]+)+")
+LABELS = re.compile(r"\b(?:name|e-?mail|contact|office(?: hours)?|phone|role)\s*:", re.I)
+ROLE_WORDS = re.compile(
+    r"\b(?:instructors?|professors?|lecturers?|course coordinators?|teaching assistants?|(?-i:TAs?)|Dr|Prof)\b\.?",
+    re.I,
+)
+
+MAILTO_LINKS = etree.XPath("descendant::a[starts-with(normalize-space(@href), 'mailto:')]")
+RECORD = etree.XPath("ancestor::*[self::tr or self::li or self::p or self::dd or self::div][1]")
+
+# Short blocks of text that only label who follows, e.g. <h4>Teaching Assistants</h4>
+LABEL_MAX_LENGTH = 60
+# Longer containers hold more than one person, so only the text right before the link is used
+RECORD_MAX_LENGTH = 200
+
+def _role(text: str) -> str | None:
+    if TA.search(text):
+        return "TA"
+    if PROFESSOR.search(text):
+        return "Professor"
+    return None
+
+def _own_text(element) -> str:
+    return " ".join((element.text or "").split())
+
+def _record_text(link) -> str:
+    """
+    Text of the row/paragraph holding link, or just what precedes it inside a large container
+    """
+    record = RECORD(link)
+    text = " ".join(" ".join((record[0] if record else link).itertext()).split())
+
+    if len(text) <= RECORD_MAX_LENGTH:
+        return text
+
+    parent = link.getparent()
+    before = [parent.text or ""]
+    for sibling in parent:
+        if sibling is link:
+            break
+        before.append(" ".join(sibling.itertext()))
+        before.append(sibling.tail or "")
+
+    return " ".join(" ".join(before).split())[-LABEL_MAX_LENGTH:] + " " + " ".join(link.itertext())
+
+def _clean(text: str) -> str:
+    return ROLE_WORDS.sub(" ", LABELS.sub(" ", EMAIL.sub(" ", text)))
+
+def _names(root) -> set[str]:
+    """
+    Every name-like run in the section, each text node on its own so neighbours never merge
+    """
+    text = _clean(" | ".join(root.itertext()))
+    return {match.group(1).strip() for match in NAME.finditer(text) if PERSON.match(match.group(1).strip())}
+
+def _name(link, record_text: str) -> str | None:
+    """
+    Prefer the link text unless it is generic, otherwise the first name-like run in the record
+    Returns None when what was found does not look like a person's name
+    """
+    link_text = " ".join(" ".join(link.itertext()).split())
+    candidates = (record_text,) if GENERIC_LINK.match(link_text) else (link_text, record_text)
+
+    for candidate in candidates:
+        match = NAME.search(_clean(candidate))
+        if match:
+            name = match.group(1).strip()
+            return name if PERSON.match(name) else None
+
+    return None
+
+def parse(section_html: str) -> records.CourseRecords | None:
+    """
+    Extract Professor/TA entries with their emails
+    Returns None when nothing usable was found, or when a role label or name in the section is
+    not tied to a mailto: link, so the caller can fall back to the LLM
+    """
+    root = etree.HTML(section_html) if section_html.strip() else None
+
+    if root is None:
+        return None
+
+    links = set(MAILTO_LINKS(root))
+
+    if not links:
+        return None
+
+    personnels = []
+    seen = set()
+    heading_role = None
+    labelled_roles = set()
+
+    # Walk in document order so each link picks up the closest preceding role label
+    for element in root.iter():
+        if not isinstance(element.tag, str):
+            continue
+
+        own = _own_text(element)
+
+        if own and len(own) <= LABEL_MAX_LENGTH and element not in links:
+            heading_role = _role(own) or heading_role
+            labelled_roles.add(_role(own))
+
+        if element not in links:
+            continue
+
+        record_text = _record_text(element)
+        role = _role(record_text) or heading_role
+
+        if role is None:
+            continue
+
+        name = _name(element, record_text)
+
+        # Guessing wrong would skip Gemini with a bad name, let it read the whole section
+        if name is None:
+            return None
+
+        email = element.get("href").strip()[len("mailto:"):].split("?")[0].strip().lower() or None
+
+        if email in const.invalid_emails:
+            email = None
+
+        if (name, role) in seen:
+            continue
+
+        seen.add((name, role))
+        personnels.append(records.Personnel(name=name, role=role, email=email))
+
+    if not personnels:
+        return None
+
+    # People listed without a link (e.g. "TAs: Bob Lee, Carol Wu") would be silently dropped
+    if labelled_roles - {None, *(p.role for p in personnels)} or _names(root) - {p.name for p in personnels}:
+        return None
+
+    return records.CourseRecords(personnels=personnels)
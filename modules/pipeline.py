@@ -0,0 +1,454 @@
+"""
+Staged scrape of one department's courses
+catalog -> page fetch (threads) -> HTML parse (process pool) -> extraction (async) -> single writer
+Stages are joined by bounded queues so a slow stage backs pressure up instead of buffering
+everything, and each queue keeps depth and wait statistics to show where the bottleneck is.
+"""
+
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Iterable, Sized
+
+from tqdm import tqdm
+
+from modules import constants as const
+from modules import extract
+from modules import fetch
+from modules import llm_control
+from modules import manifest
+from modules import metrics
+from modules import parse_course
+from modules import records
+
+# Marks the end of a stage's input
+DONE = object()
+
+class Aborted(Exception):
+    """
+    Another stage failed and the pipeline is shutting down
+    """
+
+class StageQueue:
+    """
+    Bounded queue that records how full it runs and how long each side waits on the other
+    """
+
+    def __init__(self, name: str, maxsize: int, abort: threading.Event):
+        self.name = name
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize)
+        self._abort = abort
+        self._lock = threading.Lock()
+        self._stats = {"items": 0, "depth_total": 0, "depth_max": 0, "put_wait": 0.0, "get_wait": 0.0}
+
+    def put(self, item):
+        """
+        Block while the queue is full, raising Aborted if the pipeline stops meanwhile
+        """
+        start = time.perf_counter()
+
+        while True:
+            if self._abort.is_set():
+                raise Aborted()
+            try:
+                self._queue.put(item, timeout=const.PIPELINE_POLL)
+                break
+            except queue.Full:
+                continue
+
+        depth = self._queue.qsize()
+
+        with self._lock:
+            self._stats["items"] += 1
+            self._stats["depth_total"] += depth
+            self._stats["depth_max"] = max(self._stats["depth_max"], depth)
+            self._stats["put_wait"] += time.perf_counter() - start
+
+    def get(self):
+        """
+        Block while the queue is empty, raising Aborted if the pipeline stops meanwhile
+        """
+        start = time.perf_counter()
+
+        while True:
+            if self._abort.is_set():
+                raise Aborted()
+            try:
+                item = self._queue.get(timeout=const.PIPELINE_POLL)
+                break
+            except queue.Empty:
+                continue
+
+        with self._lock:
+            self._stats["get_wait"] += time.perf_counter() - start
+
+        return item
+
+    def stats(self) -> dict:
+        """
+        Average and peak depth, and total seconds producers and consumers spent blocked
+        """
+        with self._lock:
+            items = self._stats["items"]
+            return {
+                "items": items,
+                "depth_avg": self._stats["depth_total"] / items if items else 0.0,
+                "depth_max": self._stats["depth_max"],
+                "capacity": self.maxsize,
+                "put_wait": self._stats["put_wait"],
+                "get_wait": self._stats["get_wait"],
+            }
+
+def parse_page(page_text: str) -> tuple[str, str, str] | None:
+    """
+    Description, personnel HTML and assessment HTML of an outline page, None if it has no outline
+    Runs in the parse process pool
+    """
+    res, data = parse_course.main(page_text)
+
+    if not res or "description" not in data:
+        return None
+
+    return data["description"], str(data["personnels"]), str(data["assessments_table"])
+
+def parse_page_timed(page_text: str) -> tuple[tuple[str, str, str] | None, float]:
+    """
+    parse_page and the seconds it took, so pool workers can report parse time without their own metrics
+    """
+    start = time.perf_counter()
+    sections = parse_page(page_text)
+    return sections, time.perf_counter() - start
+
+class Pipeline: # pylint: disable=too-many-instance-attributes
+    """
+    One department's run through the stages
+    Every course gets a sequence number at the source; stages pass None payloads for courses
+    they drop so the writer can commit strictly in catalog order without stalling.
+    fetch_page returns the status, text and cache validators of a course's outline page, raising
+    LookupError when it is unavailable (e.g. not archived when replaying), and may only make a
+    conditional request when told it can. A delta carries courses whose page or outline content
+    is unchanged forward instead of re-extracting them.
+    Cross-listed courses pointing at the same normalised url share one fetch and one parse, and
+    courses with identical outline sections share one extraction; each still gets its own rows.
+    Shared work is only held while some course still needs it, a course arriving after that
+    reads the page back from the archive and the extraction from the LLM cache.
+    """
+
+    def __init__(
+        self,
+        fetch_page: Callable[[dict, bool], tuple[int, str, dict[str, str]]],
+        extractor: extract.AsyncExtractor,
+        commit: Callable[[dict, str, records.CourseRecords], None],
+        *,
+        fetch_workers: int = const.FETCH_PER_HOST,
+        parse_workers: int = const.PIPELINE_PARSE_WORKERS,
+        queue_size: int = const.PIPELINE_QUEUE_SIZE,
+        delta: manifest.Delta | None = None,
+    ):
+        self.fetch_page = fetch_page
+        self.extractor = extractor
+        self.commit = commit
+        self.fetch_workers = max(1, fetch_workers)
+        self.parse_workers = parse_workers
+        self.delta = delta
+
+        # Set when any stage dies, unblocking every other stage
+        self.abort = threading.Event()
+        self.failed: list[str] = []
+        self.errors: list[BaseException] = []
+
+        # Work in progress for a page url or outline content with the number of courses using it
+        self._memo: dict[str, dict] = {"pages": {}, "parses": {}, "extractions": {}}
+        self._memo_locks = {kind: threading.Lock() for kind in self._memo}
+        self.shared = {"pages": 0, "parses": 0, "extractions": 0}
+
+        self.queues = {
+            name: StageQueue(name, queue_size, self.abort)
+            for name in ("fetch", "parse", "extract", "write")
+        }
+
+    def _fail(self, message: str):
+        tqdm.write(const.warning(message))
+        self.failed.append(message)
+
+    def _stage(self, target: Callable, *args) -> threading.Thread:
+        def run():
+            try:
+                target(*args)
+            except Aborted:
+                pass
+            except Exception as e: # pylint: disable=broad-exception-caught
+                self.errors.append(e)
+                self.abort.set()
+
+        thread = threading.Thread(target=run, name=f"pipeline-{target.__name__}", daemon=True)
+        thread.start()
+        return thread
+
+    def _shared(self, kind: str, key, start: Callable[[], Future]) -> Future:
+        """
+        Future of the work for key, started with start() unless a course still using it already did
+        Every call must be paired with a _release once the caller is done with the result
+        """
+        with self._memo_locks[kind]:
+            entry = self._memo[kind].get(key)
+
+            if entry is not None:
+                self.shared[kind] += 1
+                entry[1] += 1
+                return entry[0]
+
+            future = start()
+            self._memo[kind][key] = [future, 1]
+            return future
+
+    def _release(self, kind: str, key):
+        """
+        Forget the work for key once the last course using it is done, keeping memory flat
+        """
+        with self._memo_locks[kind]:
+            entry = self._memo[kind][key]
+            entry[1] -= 1
+
+            if not entry[1]:
+                del self._memo[kind][key]
+
+    def _fetched(self, course: dict, key: str) -> tuple[int, str, dict[str, str]]:
+        """
+        Fetch a course's page, waiting on another fetch thread that is already fetching the same url
+        """
+        owned = Future()
+        future = self._shared("pages", key, lambda: owned)
+
+        try:
+            if future is owned:
+                try:
+                    owned.set_result(self.fetch_page(course, True))
+                except BaseException as e:
+                    owned.set_exception(e)
+                    raise
+
+            status, page_text, validators = future.result()
+        finally:
+            self._release("pages", key)
+
+        # A 304 to another course's conditional request says nothing about this course's copy
+        if status == 304 and future is not owned:
+            return self.fetch_page(course, False)
+
+        return status, page_text, validators
+
+    def _source(self, courses: list[dict]):
+        for seq, course in enumerate(courses):
+            self.queues["fetch"].put((seq, course))
+
+        for _ in range(self.fetch_workers):
+            self.queues["fetch"].put(DONE)
+
+    def _fetch(self):
+        while (item := self.queues["fetch"].get()) is not DONE:
+            seq, course = item
+            key = None
+            page_text = None
+
+            tqdm.write(f"Parsing {course['courses']}...")
+
+            if not course["url"]:
+                tqdm.write(const.warning(f"No outline url provided for {course['courses']}"))
+            else:
+                key = fetch.normalize_url(course["url"])
+
+                try:
+                    status, page_text, validators = self._fetched(course, key)
+                except LookupError as e:
+                    tqdm.write(const.warning(str(e)))
+                else:
+                    tqdm.write(f"Page Status: {status}")
+
+                    if status == 404:
+                        self._fail(f"Page not found. 404 Error. {course['url']}")
+                        page_text = None
+                    elif self.delta is not None and self.delta.page_unchanged(course, status, page_text, validators):
+                        tqdm.write(f"Unchanged since the last run: {course['courses']}")
+                        page_text = None
+
+            self.queues["parse"].put((seq, course, None if page_text is None else (key, page_text)))
+
+        self.queues["parse"].put(DONE)
+
+    def _parse(self, pool: ProcessPoolExecutor | None):
+        remaining = self.fetch_workers
+
+        while remaining:
+            item = self.queues["parse"].get()
+
+            if item is DONE:
+                remaining -= 1
+                continue
+
+            seq, course, page = item
+
+            if page is None:
+                parsed = None
+            elif pool is None:
+                parsed = self._shared("parses", page[0], lambda page_text=page[1]: self._parse_inline(page_text))
+            else:
+                parsed = self._shared("parses", page[0], lambda page_text=page[1]: self._parse_pooled(pool, page_text))
+
+            self.queues["extract"].put((seq, course, None if page is None else page[0], parsed))
+
+        self.queues["extract"].put(DONE)
+
+    @staticmethod
+    def _parse_inline(page_text: str) -> Future:
+        parsed = Future()
+
+        with metrics.get_metrics().span("parse"):
+            parsed.set_result(parse_page(page_text))
+
+        return parsed
+
+    @staticmethod
+    def _parse_pooled(pool: ProcessPoolExecutor, page_text: str) -> Future:
+        parsed = Future()
+
+        def done(timed: Future):
+            try:
+                sections, seconds = timed.result()
+            except BaseException as e: # pylint: disable=broad-exception-caught
+                parsed.set_exception(e)
+                return
+
+            metrics.get_metrics().observe("parse", seconds)
+            parsed.set_result(sections)
+
+        pool.submit(parse_page_timed, page_text).add_done_callback(done)
+
+        return parsed
+
+    def _extract(self):
+        while (item := self.queues["extract"].get()) is not DONE:
+            seq, course, key, parsed = item
+            sections = None
+
+            if parsed is not None:
+                try:
+                    sections = parsed.result()
+                finally:
+                    self._release("parses", key)
+
+            if parsed is not None and sections is None:
+                self._fail(f"No outline content found for {course['courses']}")
+
+            if sections is not None and self.delta is not None and self.delta.content_unchanged(course, sections):
+                tqdm.write(f"Unchanged outline content: {course['courses']}")
+                sections = None
+
+            if sections is None:
+                self.queues["write"].put((seq, course, None, None, None))
+                continue
+
+            description, personnels_html, assessments_html = sections
+            key = (personnels_html, assessments_html)
+            extracted = self._shared(
+                "extractions",
+                key,
+                lambda: self.extractor.submit(personnels_html, assessments_html),
+            )
+            self.queues["write"].put((seq, course, description, key, extracted))
+
+        self.queues["write"].put(DONE)
+
+    def _write(self, progress: tqdm):
+        """
+        Commit courses in sequence order as their extractions finish
+        """
+        ready = {}
+        next_seq = 0
+
+        while (item := self.queues["write"].get()) is not DONE:
+            ready[item[0]] = item
+
+            while next_seq in ready:
+                _, course, description, key, future = ready.pop(next_seq)
+                next_seq += 1
+                progress.update(1)
+
+                if future is None:
+                    continue
+
+                try:
+                    extracted = future.result()
+                except llm_control.LLMCallFailed as e:
+                    # Left uncommitted so the next run retries it
+                    tqdm.write(const.err(f"Extraction failed for {course['courses']}, skipping: {e}"))
+                    continue
+                except Exception as e: # pylint: disable=broad-exception-caught
+                    # Not retryable (a rejected request, a bad key), still only this course is lost
+                    tqdm.write(const.err(f"Extraction failed for {course['courses']}, skipping: {type(e).__name__}: {e}"))
+                    continue
+                finally:
+                    self._release("extractions", key)
+
+                self.commit(course, description, extracted)
+
+    def run(self, courses: Iterable[dict], progress: bool = True) -> bool:
+        """
+        Push every course through the stages, returns False if any course had to be dropped
+        courses may be a lazy stream (e.g. a catalog still downloading); it is consumed on the
+        source thread as the fetch queue has room, and the progress bar has no total then
+        Errors raised by a stage, including the stream, are re-raised here once everything has stopped
+        """
+        # Workers start lazily, by then the extractor and fetch threads are running and a forked
+        # copy could inherit a lock some thread was holding. Windows has no forkserver
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        pool = ProcessPoolExecutor(
+            max_workers=self.parse_workers,
+            mp_context=multiprocessing.get_context(start_method),
+        ) if self.parse_workers > 0 else None
+
+        try:
+            threads = [self._stage(self._source, courses)]
+            threads += [self._stage(self._fetch) for _ in range(self.fetch_workers)]
+            threads.append(self._stage(self._parse, pool))
+            threads.append(self._stage(self._extract))
+
+            with tqdm(total=len(courses) if isinstance(courses, Sized) else None, disable=not progress) as progress_bar:
+                try:
+                    self._write(progress_bar)
+                except Aborted:
+                    pass
+                except BaseException:
+                    self.abort.set()
+                    raise
+
+            for thread in threads:
+                thread.join()
+
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+        if self.errors:
+            raise self.errors[0]
+
+        return not self.failed
+
+    def stats(self) -> dict[str, dict]:
+        """
+        Queue statistics by the stage each queue feeds
+        """
+        return {name: stage_queue.stats() for name, stage_queue in self.queues.items()}
+
+def format_stats(stats: dict[str, dict]) -> str:
+    """
+    One line per queue, a consumer that often waits is starved and a producer that often waits is blocked
+    """
+    return "\n".join(
+        f"  {name:<8} depth avg {s['depth_avg']:5.1f} max {s['depth_max']:>3}/{s['capacity']:<3}"
+        f"  producers blocked {s['put_wait']:7.2f}s  consumers starved {s['get_wait']:7.2f}s"
+        for name, s in stats.items()
+    )
@@ -4,18 +4,143 @@ Script for parsing outlines table into multiple tables
 
 import argparse
 import csv
-import json
+import io
 import os
 import uuid
-import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Iterator
 
 from tqdm import tqdm
 from modules import constants
+from modules import records
+from modules import sinks
+from modules import weights
 
-def main (verbose: bool) -> bool:
+def outline_rows(outline: list[str]) -> dict[str, list[list]]:
+    """
+    Split one outline row into the rows of every output table
+    """
+    rows = {table: [] for table in constants.PROCESS_TABLES}
+
+    course_id = outline[constants.OutlinesCols.ID.value]
+    personnel = records.loads(outline[constants.OutlinesCols.PERSONNEL.value])
+    schemes = records.loads(outline[constants.OutlinesCols.SCHEMES.value])
+
+    #personnels table
+    for person in personnel:
+        role = person.get("role").capitalize()
+        email = person.get("email")
+        if role=="Ta":
+            role = role.upper()
+
+        if email in constants.invalid_emails:
+            email = ""
+
+        rows["personnel_rows"].append([course_id, person.get("name"), role, email])
+
+    #assessments & conditions table
+    for scheme in schemes:
+        condition = scheme.get("condition")
+        condition_assessment = condition.get("symbol")
+        condition_assessment_id = None
+        scheme_num: int = scheme.get("schemeNum")
+        assessments = scheme.get("assessments")
+
+        for assessment_group in assessments:
+            assessment_group_id = uuid.uuid4()
+
+            weight = weights.parse(assessment_group.get("weight"))
+
+            count = assessment_group.get("count")
+
+            if not count:
+                count = 1
+            else:
+                count = int(count)
+
+            drop = assessment_group.get("drop")
+
+            if not drop:
+                drop = 0
+            else:
+                drop = int(drop)
+
+            name = str(assessment_group.get("name"))
+            a_type = str(assessment_group.get("assessmentType"))
+
+            optional = False
+
+            if "optional" in name.lower() or "optional" in a_type.lower():
+                optional = True
+
+            rows["assessment_groups_rows"].append([assessment_group_id, course_id, weight, count, drop, name, a_type, optional])
+
+            individual_weight = weight/count
+
+            if assessment_group.get("symbol")==condition_assessment:
+                condition_assessment_id = assessment_group_id
+
+            rows["assessments_rows"].extend(
+                [uuid.uuid4(), assessment_group_id, individual_weight, index, None, name]
+                for index in range(count)
+            )
+
+        rows["conditions_rows"].append([course_id, condition_assessment_id, scheme_num, condition.get("lowerBound"), condition.get("upperBound")])
+
+    return rows
+
+def process_chunk(chunk: bytes) -> dict[str, list[list]]:
+    """
+    Rows of every output table for a chunk of whole outline records
+    """
+    rows = {table: [] for table in constants.PROCESS_TABLES}
+
+    for outline in csv.reader(io.StringIO(chunk.decode("utf-8"), newline=""), lineterminator="\n"):
+        for table, table_rows in outline_rows(outline).items():
+            rows[table].extend(table_rows)
+
+    return rows
+
+def record_boundary(buffer: bytes) -> int:
+    """
+    End of the last complete CSV record in buffer, 0 if there is none
+    buffer must start on a record boundary; a newline only ends a record outside quotes,
+    i.e. when an even number of quote characters precede it
+    """
+    end = buffer.rfind(b"\n")
+    quotes = buffer.count(b'"', 0, end) if end != -1 else 0
+
+    while end != -1 and quotes % 2:
+        previous = buffer.rfind(b"\n", 0, end)
+        quotes -= buffer.count(b'"', previous + 1, end)
+        end = previous
+
+    return end + 1
+
+def read_chunks(outlines_csv: BinaryIO, chunk_size: int) -> Iterator[bytes]:
+    """
+    Stream the body of the outlines dump as chunks that never split a record
+    """
+    carry = b""
+
+    while block := outlines_csv.read(chunk_size):
+        buffer = carry + block
+        end = record_boundary(buffer)
+
+        if end:
+            yield buffer[:end]
+        carry = buffer[end:]
+
+    if carry.strip():
+        yield carry
+
+def main (verbose: bool, sink: str = "csv", workers: int | None = None) -> bool:
     """
     Process outline table CSV
     Main objective is to split the "outlines" array columns like personnel and schemes, into their own tables
+    The dump is read once in record aligned chunks which a process pool splits in parallel,
+    results are written back in input order
     """
 
     if not os.path.exists(constants.OUTPUT_PATH):
@@ -23,114 +148,38 @@ def main (verbose: bool) -> bool:
         if verbose:
             tqdm.write(f"Succesfully created path for CSVs: {constants.OUTPUT_PATH}")
 
-    result, num_rows = constants.count_rows('outlines_rows.csv')
-
-    if not result:
-        return False
+    workers = workers or os.cpu_count() or 1
+    path = constants.INPUT_PATH+'outlines_rows.csv'
 
     try:
-        with open(constants.INPUT_PATH+'outlines_rows.csv', "r", encoding="utf-8") as outlines_csv, open(constants.PERSONNEL_PATH, "w", encoding="utf-8") as personnel_csv, open(constants.CONDITIONS_PATH, "w", encoding="utf-8") as conditions_csv, open(constants.ASSESSMENTS_PATH, "w", encoding="utf-8") as assessments_csv, open(constants.ASSESSMENT_GROUPS_PATH, "w", encoding="utf-8") as assessment_group_csv:
-            outlines_reader = csv.reader(outlines_csv, lineterminator="\n")
-            personnel_writer = csv.writer(personnel_csv, lineterminator="\n")
-            conditions_writer = csv.writer(conditions_csv, lineterminator="\n")
-            assessments_writer = csv.writer(assessments_csv, lineterminator="\n")
-            assessment_groups_writer = csv.writer(assessment_group_csv, lineterminator="\n")
-
-            for i, outline in tqdm(enumerate(outlines_reader), total=num_rows):
-                if i == 0:
-                    personnel_writer.writerow(constants.personnel_columns)
-                    conditions_writer.writerow(constants.conditions_columns)
-                    assessments_writer.writerow(constants.assessments_columns)
-                    assessment_groups_writer.writerow(constants.assessment_groups_columns)
-                    continue
-
-                course_id = outline[constants.OutlinesCols.ID.value]
-                personnel = json.loads(outline[constants.OutlinesCols.PERSONNEL.value])
-                schemes = json.loads(outline[constants.OutlinesCols.SCHEMES.value])
-
-                #personnels table
-                for person in personnel:
-                    role = person.get("role").capitalize()
-                    email = person.get("email")
-                    if role=="Ta":
-                        role = role.upper()
-
-                    if email in constants.invalid_emails:
-                        email = ""
-
-                    personnel_writer.writerow([course_id, person.get("name"), role, email])
-
-                #assessments & conditions table
-                for scheme in schemes:
-                    condition = scheme.get("condition")
-                    condition_assessment = condition.get("symbol")
-                    condition_assessment_id = None
-                    scheme_num: int = scheme.get("schemeNum")
-                    assessments = scheme.get("assessments")
-
-                    for assessment_group in assessments:
-                        assessment_group_id = uuid.uuid4()
-
-                        weight = assessment_group.get("weight").lower()
-
-                        if weight=="ungraded":
-                            weight = 0
-                        else:
-                            cleaned_weight = re.sub(r'[^0-9\.\-\%]', '', weight)
-                            if cleaned_weight.endswith("%"):
-                                numbers = [float(n) for n in re.findall(r'(\d+(?:\.\d+)?)%', weight)]
-                                if not numbers:
-                                    weight = 0
-                                else:
-                                    max_percent = max(numbers)
-
-                                    if str(weight).startswith("a*"):
-                                        weight = float(weight[2:-1])/50
-                                    else:
-                                        weight = max_percent/100
-                            else:
-                                try:
-                                    weight = float(cleaned_weight)
-                                except ValueError:
-                                    weight = 0
-
-                        count = assessment_group.get("count")
-
-                        if not count:
-                            count = 1
-                        else:
-                            count = int(count)
-
-                        drop = assessment_group.get("drop")
-
-                        if not drop:
-                            drop = 0
-                        else:
-                            drop = int(drop)
-
-                        name = str(assessment_group.get("name"))
-                        a_type = str(assessment_group.get("assessmentType"))
-
-                        optional = False
-
-                        if "optional" in name.lower() or "optional" in a_type.lower():
-                            optional = True
-
-                        assessment_groups_writer.writerow([assessment_group_id, course_id, weight, count, drop, name, a_type, optional])
-
-                        individual_weight = weight/count
-
-                        if assessment_group.get("symbol")==condition_assessment:
-                            condition_assessment_id = assessment_group_id
-
-                        for i in range(count):
-                            assessments_writer.writerow([assessment_group_id, individual_weight, i if count > 0 else ""])
-
-                    conditions_writer.writerow([course_id, condition_assessment_id, scheme_num, condition.get("lowerBound"), condition.get("upperBound")])
-
-                    tqdm.write(str(assessments))
-
-    except IOError as e:
+        with (
+            open(path, "rb") as outlines_csv,
+            sinks.open_sink(sink, constants.OUTPUT_PATH, constants.PROCESS_TABLES) as output,
+            tqdm(total=os.path.getsize(path), unit="B", unit_scale=True) as progress,
+            ProcessPoolExecutor(max_workers=workers) as pool,
+        ):
+            progress.update(len(outlines_csv.readline()))
+
+            # Bounded so a fast reader never holds more than a few chunks per worker in memory
+            pending = deque()
+
+            def drain(limit: int):
+                while len(pending) > limit:
+                    size, future = pending.popleft()
+                    for table, rows in future.result().items():
+                        output.write(table, rows)
+                    progress.update(size)
+
+            for chunk in read_chunks(outlines_csv, constants.PROCESS_CHUNK_SIZE):
+                pending.append((len(chunk), pool.submit(process_chunk, chunk)))
+                drain(workers * constants.PROCESS_CHUNKS_PER_WORKER)
+
+            drain(0)
+
+            if verbose:
+                tqdm.write(f"Processed {progress.n:,} bytes with {workers} workers")
+
+    except (IOError, ImportError) as e:
         tqdm.write(constants.err(str(e)))
         return False
 
@@ -149,9 +198,24 @@ if __name__ == "__main__":
         help="Make output more verbose with logging"
     )
 
+    _ = parser.add_argument(
+        "--sink",
+        choices=constants.SINKS,
+        default="csv",
+        help="Output format for the split tables"
+    )
+
+    _ = parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Processes splitting the dump in parallel, defaults to the CPU count"
+    )
+
     args: argparse.Namespace = parser.parse_args()
 
-    if main(args.verbose):
+    if main(args.verbose, args.sink, args.workers):
         tqdm.write("Process completed successfully.")
     else:
         tqdm.write("Process failed. Check logs for more info.")
@@ -0,0 +1,164 @@
+"""
+Lean internal records for extracted course data
+Pydantic models in models.py are only the Gemini response schema; everything after
+that boundary (local parsers, cache hits, ID assignment, row building) uses these.
+"""
+
+import json
+from dataclasses import dataclass, field
+from uuid import uuid4
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loads(data: str | bytes):
+    """
+    Decode JSON, with orjson when it is installed
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(value) -> str:
+    """
+    Encode JSON, with orjson when it is installed
+    """
+    if orjson is not None:
+        return orjson.dumps(value).decode("utf-8")
+    return json.dumps(value, separators=(",", ":"))
+
+@dataclass(slots=True)
+class Personnel:
+    """
+    One Professor/TA entry
+    """
+    name: str
+    role: str
+    email: str | None
+
+@dataclass(slots=True)
+class AssessmentGroup:
+    """
+    One weighted group of assessments, id is a placeholder (G1, G2, ...) until assign_ids
+    """
+    id: str
+    weight: float
+    count: int
+    drop: int
+    name: str
+    optional: bool
+    type: str | None = None
+
+@dataclass(slots=True)
+class Assessment:
+    """
+    One assessment inside a group
+    """
+    group_id: str
+    weight: float
+    index: int
+    due_date: str | None
+    name: str
+    id: str | None = None
+
+@dataclass(slots=True)
+class CourseRecords:
+    """
+    Everything extracted for one course
+    """
+    personnels: list[Personnel] = field(default_factory=list)
+    assessment_groups: list[AssessmentGroup] = field(default_factory=list)
+    assessments: list[Assessment] = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CourseRecords":
+        """
+        Build from decoded ParsedCourseOutput JSON
+        """
+        return cls(
+            personnels=[
+                Personnel(p["name"], p["role"], p.get("email"))
+                for p in data.get("personnels") or []
+            ],
+            assessment_groups=[
+                AssessmentGroup(
+                    g["id"], g["weight"], g["count"], g["drop"], g["name"], g["optional"], g.get("type")
+                )
+                for g in data.get("assessment_groups") or []
+            ],
+            assessments=[
+                Assessment(a["group_id"], a["weight"], a["index"], a.get("due_date"), a["name"])
+                for a in data.get("assessments") or []
+            ],
+        )
+
+    @classmethod
+    def from_json(cls, data: str | bytes) -> "CourseRecords":
+        """
+        Build from ParsedCourseOutput JSON without going through pydantic
+        """
+        return cls.from_dict(loads(data))
+
+    @classmethod
+    def from_model(cls, parsed) -> "CourseRecords":
+        """
+        Build from a parsed Gemini response (models.ParsedCourseOutput)
+        """
+        return cls(
+            personnels=[Personnel(p.name, p.role, p.email) for p in parsed.personnels],
+            assessment_groups=[
+                AssessmentGroup(g.id, g.weight, g.count, g.drop, g.name, g.optional)
+                for g in parsed.assessment_groups
+            ],
+            assessments=[
+                Assessment(a.group_id, a.weight, a.index, a.due_date, a.name)
+                for a in parsed.assessments
+            ],
+        )
+
+    def to_dict(self) -> dict:
+        """
+        Plain dict in the ParsedCourseOutput layout
+        """
+        return {
+            "personnels": [
+                {"name": p.name, "role": p.role, "email": p.email} for p in self.personnels
+            ],
+            "assessment_groups": [
+                {
+                    "id": g.id, "weight": g.weight, "count": g.count, "drop": g.drop,
+                    "name": g.name, "optional": g.optional, "type": g.type,
+                }
+                for g in self.assessment_groups
+            ],
+            "assessments": [
+                {
+                    "id": a.id, "group_id": a.group_id, "weight": a.weight, "index": a.index,
+                    "due_date": a.due_date, "name": a.name,
+                }
+                for a in self.assessments
+            ],
+        }
+
+    def to_json(self) -> str:
+        """
+        ParsedCourseOutput JSON of these records
+        """
+        return dumps(self.to_dict())
+
+    def assign_ids(self):
+        """
+        Replace placeholder group ids with real UUIDs and give every assessment one, in place
+        """
+        group_id_map = {}
+
+        for group in self.assessment_groups:
+            real_id = str(uuid4())
+            group_id_map[group.id] = real_id
+            group.id = real_id
+
+        for assessment in self.assessments:
+            assessment.id = str(uuid4())
+            assessment.group_id = group_id_map.get(assessment.group_id, assessment.group_id)
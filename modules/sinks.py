@@ -0,0 +1,449 @@
+"""
+Output sinks for the scrape, process and aggregate tables
+"""
+
+import glob
+import os
+import sqlite3
+import time
+from uuid import uuid4
+
+from tqdm import tqdm
+
+from modules import constants as const
+from modules import journal
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+def convert(value, kind: str):
+    """
+    Coerce a CSV style value to the column type
+    """
+    if value is None or value == "":
+        return None
+    if kind == "float64":
+        return float(value)
+    if kind == "int64":
+        return int(value)
+    if kind == "bool":
+        return value if isinstance(value, bool) else str(value).lower() == "true"
+    return str(value)
+
+def schema(columns: list[str]):
+    """
+    Arrow schema for a column list, typed through const.COLUMN_TYPES
+    """
+    return pa.schema([(column, const.COLUMN_TYPES.get(column, "string")) for column in columns])
+
+class CsvSink:
+    """
+    One CSV file per table, truncated and given a header on open
+    """
+
+    def __init__(self, directory: str, tables: dict[str, list[str]]):
+        self._files = {}
+        self._writers = {}
+
+        for table, columns in tables.items():
+            path = os.path.join(directory, f"{table}.csv")
+            if os.path.isfile(path):
+                os.remove(path)
+            self._files[table], self._writers[table] = const.open_csv_with_header(path, columns)
+
+    def write(self, table: str, rows: list[list]):
+        """
+        Write rows to table
+        """
+        self._writers[table].writerows(rows)
+
+    def close(self):
+        """
+        Close every table
+        """
+        for csv_file in self._files.values():
+            csv_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+class ParquetSink: # pylint: disable=too-many-instance-attributes
+    """
+    One directory of Parquet part files per table
+    Rows are buffered and written in row groups. Parts are written under a .tmp name and
+    only renamed once complete, outlines last, so a crash never leaves a readable partial part.
+    """
+
+    def __init__(self, directory: str, tables: dict[str, list[str]]):
+        if pa is None:
+            raise ImportError("pyarrow is required for the parquet sink, pip install pyarrow")
+
+        self.directory = directory
+        self.tables = tables
+        self._types = {
+            table: (schema(columns), [const.COLUMN_TYPES.get(column, "string") for column in columns])
+            for table, columns in tables.items()
+        }
+        self._buffers: dict[str, list[list]] = {table: [] for table in tables}
+        self._writers = {}
+        self._run = f"{int(time.time())}-{uuid4().hex[:8]}"
+        self._part = 0
+        self._courses = 0
+
+        for table in tables:
+            os.makedirs(self.table_path(table), exist_ok=True)
+
+        self.recover()
+
+    def table_path(self, table: str) -> str:
+        """
+        Directory holding the parts of table
+        """
+        return os.path.join(self.directory, table)
+
+    def _part_path(self, table: str) -> str:
+        return os.path.join(self.table_path(table), f"part-{self._run}-{self._part:05d}.parquet")
+
+    def recover(self):
+        """
+        Remove unfinished parts and parts whose outlines part was never renamed into place
+        """
+        for table in self.tables:
+            for path in glob.glob(os.path.join(self.table_path(table), "*.tmp")):
+                os.remove(path)
+
+        if "outlines" not in self.tables:
+            return
+
+        committed = {os.path.basename(path) for path in glob.glob(os.path.join(self.table_path("outlines"), "*.parquet"))}
+
+        for table in self.tables:
+            for path in glob.glob(os.path.join(self.table_path(table), "*.parquet")):
+                if os.path.basename(path) not in committed:
+                    os.remove(path)
+
+    def write(self, table: str, rows: list[list]):
+        """
+        Buffer rows for table, writing a row group once enough are buffered
+        """
+        buffer = self._buffers[table]
+        buffer.extend(rows)
+
+        if len(buffer) >= const.PARQUET_ROW_GROUP_SIZE:
+            self._flush(table)
+
+    def _flush(self, table: str):
+        buffer = self._buffers[table]
+
+        if not buffer:
+            return
+
+        table_schema, kinds = self._types[table]
+        arrays = [
+            pa.array([convert(row[i], kind) for row in buffer], type=field.type)
+            for i, (field, kind) in enumerate(zip(table_schema, kinds))
+        ]
+
+        if table not in self._writers:
+            self._writers[table] = pq.ParquetWriter(
+                self._part_path(table) + ".tmp", table_schema, compression=const.PARQUET_COMPRESSION
+            )
+
+        self._writers[table].write_batch(pa.record_batch(arrays, schema=table_schema))
+        buffer.clear()
+
+    def rotate(self):
+        """
+        Finish the current parts and start new ones
+        """
+        for table in self.tables:
+            self._flush(table)
+
+        for table in sorted(self._writers, key=lambda name: name == "outlines"):
+            self._writers[table].close()
+            os.replace(self._part_path(table) + ".tmp", self._part_path(table))
+
+        self._writers = {}
+        self._part += 1
+        self._courses = 0
+
+    def commit(self, rows: dict[str, list[list]]):
+        """
+        Write every table's rows for one course
+        Parts roll over every const.PARQUET_PART_COURSES courses to bound work lost in a crash
+        """
+        for table, table_rows in rows.items():
+            self.write(table, table_rows)
+
+        self._courses += 1
+
+        if self._courses >= const.PARQUET_PART_COURSES:
+            self.rotate()
+
+    def completed_codes(self) -> set[str]:
+        """
+        Course codes in committed outlines parts
+        """
+        codes = set()
+
+        for path in glob.glob(os.path.join(self.table_path("outlines"), "*.parquet")):
+            codes.update(pq.read_table(path, columns=["code"]).column("code").to_pylist())
+
+        return codes
+
+    def close(self):
+        """
+        Flush and finish every part
+        """
+        self.rotate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+class SqliteSink:
+    """
+    All departments in one SQLite database (WAL mode) with foreign keys to outlines.id
+    Rerunning a course updates its outline in place and replaces its child rows. Courses
+    are buffered and written in short batched transactions so parallel workers sharing the
+    database only hold the write lock briefly.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS outlines (
+            id TEXT PRIMARY KEY,
+            code TEXT NOT NULL,
+            name TEXT,
+            description TEXT,
+            term TEXT NOT NULL,
+            url TEXT,
+            UNIQUE (code, term)
+        );
+        CREATE TABLE IF NOT EXISTS sections (
+            section TEXT,
+            course_id TEXT NOT NULL REFERENCES outlines (id) ON DELETE CASCADE
+        );
+        CREATE TABLE IF NOT EXISTS types (
+            type TEXT,
+            course_id TEXT NOT NULL REFERENCES outlines (id) ON DELETE CASCADE
+        );
+        CREATE TABLE IF NOT EXISTS assessment_groups (
+            id TEXT PRIMARY KEY,
+            course_id TEXT NOT NULL REFERENCES outlines (id) ON DELETE CASCADE,
+            weight REAL,
+            count INTEGER,
+            "drop" INTEGER,
+            name TEXT,
+            type TEXT,
+            optional INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS assessments (
+            id TEXT PRIMARY KEY,
+            group_id TEXT NOT NULL REFERENCES assessment_groups (id) ON DELETE CASCADE,
+            weight REAL,
+            "index" INTEGER,
+            due_date TEXT,
+            name TEXT
+        );
+        CREATE TABLE IF NOT EXISTS personnels (
+            course_id TEXT NOT NULL REFERENCES outlines (id) ON DELETE CASCADE,
+            name TEXT,
+            role TEXT,
+            email TEXT
+        );
+        CREATE INDEX IF NOT EXISTS outlines_code ON outlines (code);
+        CREATE INDEX IF NOT EXISTS outlines_term ON outlines (term);
+        CREATE INDEX IF NOT EXISTS sections_course_id ON sections (course_id);
+        CREATE INDEX IF NOT EXISTS types_course_id ON types (course_id);
+        CREATE INDEX IF NOT EXISTS assessment_groups_course_id ON assessment_groups (course_id);
+        CREATE INDEX IF NOT EXISTS assessments_group_id ON assessments (group_id);
+        CREATE INDEX IF NOT EXISTS personnels_course_id ON personnels (course_id);
+    """
+
+    # Child tables that hang off outlines.id directly; assessments go through assessment_groups
+    COURSE_TABLES = ("personnels", "assessment_groups", "sections", "types")
+
+    def __init__(self, path: str, dept: str, term: str):
+        # Department prefix and term whose courses this sink resumes from
+        self.scope = (dept, term)
+        self._pending: list[dict[str, list[list]]] = []
+        self._flushed_at = time.monotonic()
+
+        self._conn = sqlite3.connect(path, timeout=120, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(self.SCHEMA)
+
+        self._inserts = {
+            table: 'INSERT INTO {} ({}) VALUES ({})'.format( # pylint: disable=consider-using-f-string
+                table, ", ".join(f'"{column}"' for column in columns), ", ".join("?" * len(columns))
+            )
+            for table, columns in const.SCRAPE_TABLES.items() if table != "outlines"
+        }
+        self._kinds = {
+            table: [const.COLUMN_TYPES.get(column, "string") for column in columns]
+            for table, columns in const.SCRAPE_TABLES.items()
+        }
+
+    def completed_codes(self) -> set[str]:
+        """
+        Codes of this department's courses already stored for the term
+        """
+        dept, term = self.scope
+
+        # A range on code rather than LIKE so the lookup stays on the index
+        rows = self._conn.execute(
+            "SELECT code FROM outlines WHERE term = ? AND code >= ? AND code < ?",
+            (term, f"{dept} ", f"{dept}!"),
+        )
+        return {code for (code,) in rows}
+
+    def commit(self, rows: dict[str, list[list]]):
+        """
+        Queue one course, writing the queue once it is a full batch or old enough
+        """
+        self._pending.append(rows)
+
+        if (
+            len(self._pending) >= const.SQLITE_BATCH_COURSES
+            or time.monotonic() - self._flushed_at >= const.SQLITE_BATCH_SECONDS
+        ):
+            self.flush()
+
+    def _typed(self, table: str, row: list) -> list:
+        return [convert(value, kind) for value, kind in zip(row, self._kinds[table])]
+
+    def _upsert(self, rows: dict[str, list[list]]):
+        outline = self._typed("outlines", rows["outlines"][0])
+        new_id, code, term = outline[0], outline[1], outline[4]
+
+        existing = self._conn.execute(
+            "SELECT id FROM outlines WHERE code = ? AND term = ?", (code, term)
+        ).fetchone()
+        course_id = existing[0] if existing else new_id
+
+        self._conn.execute(
+            """
+            INSERT INTO outlines (id, code, name, description, term, url) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (code, term) DO UPDATE SET
+                name = excluded.name, description = excluded.description, url = excluded.url
+            """,
+            [course_id] + outline[1:],
+        )
+
+        for table in self.COURSE_TABLES:
+            self._conn.execute(f"DELETE FROM {table} WHERE course_id = ?", (course_id,))
+
+        group_ids = {row[0] for row in rows.get("assessment_groups", [])}
+
+        for table, insert in self._inserts.items():
+            table_rows = rows.get(table, [])
+
+            if table == "assessments":
+                # One extracted item pointing at no group must not fail the foreign key for the whole batch
+                orphans = [row for row in table_rows if row[1] not in group_ids]
+                if orphans:
+                    tqdm.write(const.warning(f"Dropped {len(orphans)} assessments of {code} with no matching group"))
+                    table_rows = [row for row in table_rows if row[1] in group_ids]
+
+            typed = [self._typed(table, row) for row in table_rows]
+
+            if table in self.COURSE_TABLES:
+                position = const.SCRAPE_TABLES[table].index("course_id")
+                for row in typed:
+                    row[position] = course_id
+
+            self._conn.executemany(insert, typed)
+
+    def flush(self):
+        """
+        Write every queued course in a single transaction
+        """
+        if self._pending:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for rows in self._pending:
+                    self._upsert(rows)
+            except BaseException:
+                # Whatever failed, never leave the write lock held
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            self._pending = []
+
+        self._flushed_at = time.monotonic()
+
+    def close(self):
+        """
+        Write what is queued and close the database
+        """
+        try:
+            self.flush()
+        finally:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+def open_sink(kind: str, directory: str, tables: dict[str, list[str]]) -> CsvSink | ParquetSink:
+    """
+    Table sink of the given kind, replacing any previous output of those tables
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    if kind == "parquet":
+        for table in tables:
+            for path in glob.glob(os.path.join(directory, table, "*.parquet")):
+                os.remove(path)
+        return ParquetSink(directory, tables)
+
+    return CsvSink(directory, tables)
+
+def open_course_sink(kind: str, dept: str, term: str) -> journal.CourseJournal | ParquetSink | SqliteSink:
+    """
+    Per course sink for a department's scrape output, appending to what is already there
+    """
+    if kind == "sqlite":
+        os.makedirs(os.path.dirname(const.SQLITE_PATH), exist_ok=True)
+        return SqliteSink(const.SQLITE_PATH, dept, term)
+
+    directory = f"{const.SCRAPE_OUTPUT_PATH}{dept}"
+    os.makedirs(directory, exist_ok=True)
+
+    if kind == "parquet":
+        return ParquetSink(directory, const.SCRAPE_TABLES)
+
+    return journal.CourseJournal(directory)
+
+def merge_parquet(sources: list[str], destination: str, columns: list[str]) -> int:
+    """
+    Stream the record batches of sources into a single Parquet file
+    Returns the number of rows written
+    """
+    if pa is None:
+        raise ImportError("pyarrow is required for the parquet sink, pip install pyarrow")
+
+    rows = 0
+    table_schema = schema(columns)
+
+    with pq.ParquetWriter(destination + ".tmp", table_schema, compression=const.PARQUET_COMPRESSION) as writer:
+        for source in sources:
+            for batch in pq.ParquetFile(source).iter_batches(batch_size=const.PARQUET_ROW_GROUP_SIZE):
+                writer.write_batch(batch)
+                rows += batch.num_rows
+
+    os.replace(destination + ".tmp", destination)
+
+    return rows
@@ -0,0 +1,171 @@
+"""
+Weight expression parsing shared by process_outlines and the local assessment parser
+Outline dumps repeat a small vocabulary of weight strings ("10%", "Ungraded", ...),
+so parsed values are memoized.
+"""
+
+import argparse
+import re
+import timeit
+from functools import lru_cache
+from typing import Iterable
+
+from tqdm import tqdm
+
+from modules import constants as const
+
+CLEAN = re.compile(r"[^0-9\.\-\%]")
+PERCENTS = re.compile(r"(\d+(?:\.\d+)?)%")
+# Looser form used on free text, allows a space before the percent sign
+PERCENT = re.compile(r"(\d+(?:\.\d+)?)\s*%")
+
+# Expected value of parse() for the weight strings seen in outline dumps
+GOLDEN = {
+    "10%": 0.1,
+    "12.5%": 0.125,
+    "Ungraded": 0,
+    "ungraded": 0,
+    "2 x 5%": 0.05,
+    "5% - 15%": 0.15,
+    "Best of 20% or 30%": 0.3,
+    "a*40%": 0.8,
+    "A*25%": 0.5,
+    "0.3": 0.3,
+    "1.5": 1.5,
+    "25": 25.0,
+    "10 %": 0,
+    "-%": 0,
+    "N/A": 0,
+    "see below": 0,
+    "": 0,
+}
+
+@lru_cache(maxsize=const.WEIGHT_CACHE_SIZE)
+def parse(weight: str) -> float:
+    """
+    Normalise an outline weight string to a fraction of the final grade
+    Percentages use the largest value given, "a*NN%" is NN/50, "ungraded" and anything unreadable is 0
+    """
+    weight = weight.lower()
+
+    if weight == "ungraded":
+        return 0
+
+    cleaned_weight = CLEAN.sub("", weight)
+
+    if cleaned_weight.endswith("%"):
+        numbers = [float(n) for n in PERCENTS.findall(weight)]
+        if not numbers:
+            return 0
+
+        if weight.startswith("a*"):
+            return float(weight[2:-1])/50
+
+        return max(numbers)/100
+
+    try:
+        return float(cleaned_weight)
+    except ValueError:
+        return 0
+
+def parse_many(weights: Iterable[str]) -> list[float]:
+    """
+    Normalise a whole column of weight strings, parsing each distinct string once
+    """
+    weights = list(weights)
+    parsed = {weight: parse(weight) for weight in set(weights)}
+    return [parsed[weight] for weight in weights]
+
+@lru_cache(maxsize=const.WEIGHT_CACHE_SIZE)
+def percents(text: str) -> tuple[float, ...]:
+    """
+    Every "NN%" value in free text, in order
+    """
+    return tuple(float(n) for n in PERCENT.findall(text))
+
+def stats() -> dict:
+    """
+    Hit rate of the weight memo
+    """
+    info = parse.cache_info()
+    lookups = info.hits + info.misses
+
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "hit_rate": info.hits / lookups if lookups else 0.0,
+    }
+
+def check_golden() -> list[str]:
+    """
+    Weight strings whose parsed value no longer matches GOLDEN
+    """
+    return [
+        f"{weight!r}: expected {expected!r}, got {parse(weight)!r}"
+        for weight, expected in GOLDEN.items()
+        if parse(weight) != expected or type(parse(weight)) is not type(expected)
+    ]
+
+def _inline(weight: str) -> float:
+    """
+    The uncached regex-per-call version parse() replaced, kept for the benchmark
+    """
+    weight = weight.lower()
+    if weight == "ungraded":
+        return 0
+    cleaned_weight = re.sub(r"[^0-9\.\-\%]", "", weight)
+    if cleaned_weight.endswith("%"):
+        numbers = [float(n) for n in re.findall(r"(\d+(?:\.\d+)?)%", weight)]
+        if not numbers:
+            return 0
+        if weight.startswith("a*"):
+            return float(weight[2:-1])/50
+        return max(numbers)/100
+    try:
+        return float(cleaned_weight)
+    except ValueError:
+        return 0
+
+def benchmark(rows: int):
+    """
+    Time a column of repeated weight strings through the inline and memoized parsers
+    """
+    column = [list(GOLDEN)[i % len(GOLDEN)] for i in range(rows)]
+
+    parse.cache_clear()
+
+    inline = timeit.timeit(lambda: [_inline(weight) for weight in column], number=1)
+    memoized = timeit.timeit(lambda: [parse(weight) for weight in column], number=1)
+    batch = timeit.timeit(lambda: parse_many(column), number=1)
+
+    tqdm.write(f"{rows:,} weights")
+    tqdm.write(f"  inline    {inline:.3f}s")
+    tqdm.write(f"  memoized  {memoized:.3f}s  ({inline / memoized:.1f}x)")
+    tqdm.write(f"  batch     {batch:.3f}s  ({inline / batch:.1f}x)")
+    tqdm.write(f"  hit rate  {stats()['hit_rate']:.2%}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the weight parser against its golden table and benchmark it"
+    )
+
+    _ = parser.add_argument(
+        "-n",
+        "--rows",
+        type=int,
+        default=500_000,
+        help="Number of weight strings in the benchmark column"
+    )
+
+    args: argparse.Namespace = parser.parse_args()
+
+    failures = check_golden()
+
+    for failure in failures:
+        tqdm.write(const.err(failure))
+
+    if not failures:
+        tqdm.write(const.success(f"All {len(GOLDEN)} golden weights match"))
+
+    benchmark(args.rows)